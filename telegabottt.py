@@ -1,12 +1,25 @@
 import os
 import json
 import asyncio
+import hashlib
 import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from io import BytesIO
+from collections import OrderedDict, deque
 from datetime import timedelta
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, BufferedInputFile
+from aiogram.types import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+import aiohttp
 import discord
 from discord import Webhook, File
 from discord.utils import get as discord_get
@@ -18,17 +31,330 @@ DC_TOKEN = os.getenv("DC_TOKEN")
 GUILD_ID = int(os.getenv("DISCORD_GUILD_ID") or 0)
 DEFAULT_CHANNEL_ID = int(os.getenv("DISCORD_CHANNEL_ID") or 0)
 TMP_DIR = "tmp"
-MAX_FILE_SIZE = 8 * 1024 * 1024  # ~8 MB
+TG_DOWNLOAD_LIMIT = int(os.getenv("TG_DOWNLOAD_LIMIT") or 20 * 1024 * 1024)  # getFile отдаёт боту файлы до 20 MB
+TG_UPLOAD_LIMIT = int(os.getenv("TG_UPLOAD_LIMIT") or 50 * 1024 * 1024)  # бот загружает в Telegram файлы до 50 MB
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL") or 2.0)  # секунд между сбросами состояния на диск
+PERSIST_MAX_DIRTY = int(os.getenv("PERSIST_MAX_DIRTY") or 200)  # сбросить раньше, если накопилось столько изменений
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS") or 16)  # сколько чатов обслуживаем одновременно при рассылке
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE") or 30)  # сообщений в секунду на весь бот
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE") or 20) / 60  # в группу: ~20 сообщений в минуту
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE") or 1)  # в ЛС: ~1 сообщение в секунду
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES") or 5)  # сколько раз повторять после flood-wait
+LINKS_MAX_ENTRIES = int(os.getenv("LINKS_MAX_ENTRIES") or 100000)  # сколько копий (chat_id, message_id) помнить для ответов/правок
+LINKS_MAX_AGE = int(os.getenv("LINKS_MAX_AGE") or 7 * 24 * 3600)  # забывать связи без обращений дольше (сек)
+DEDUPE_WINDOW = int(os.getenv("DEDUPE_WINDOW") or 24 * 3600)  # сколько помнить пересланные сообщения от повторов (сек)
+DEDUPE_MAX = int(os.getenv("DEDUPE_MAX") or 100000)  # и не больше стольких
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND") or "json"  # "json" (файлы) или "sqlite"
+DB_FILE = os.getenv("DB_FILE") or "bridge.db"
+PERSIST_WEBHOOKS = (os.getenv("PERSIST_WEBHOOKS") or "0") == "1"  # помнить id/token webhook между перезапусками (токен — секрет!)
+AVATAR_TTL = int(os.getenv("AVATAR_TTL") or 1800)  # сколько помнить avatar_url (ссылки TG живут ~1 час)
+AVATAR_NEGATIVE_TTL = int(os.getenv("AVATAR_NEGATIVE_TTL") or 600)  # сколько помнить, что фото нет
+AVATAR_CACHE_SIZE = int(os.getenv("AVATAR_CACHE_SIZE") or 5000)
+ALBUM_WAIT = float(os.getenv("ALBUM_WAIT") or 1.0)  # сколько ждать остальные части альбома (сек)
+MEDIA_SPOOL_THRESHOLD = int(os.getenv("MEDIA_SPOOL_THRESHOLD") or 16 * 1024 * 1024)  # файлы больше — через диск
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY") or 4)  # сколько файлов качаем одновременно
+DOWNLOAD_BUDGET = int(os.getenv("DOWNLOAD_BUDGET") or 512 * 1024 * 1024)  # сколько байт медиа держим в памяти/TMP_DIR
+TMP_MAX_AGE = int(os.getenv("TMP_MAX_AGE") or 30 * 60)  # осиротевшие файлы в TMP_DIR старше этого удаляем (сек)
+TMP_JANITOR_INTERVAL = int(os.getenv("TMP_JANITOR_INTERVAL") or 5 * 60)
+DC_BACKFILL_BATCH = int(os.getenv("DC_BACKFILL_BATCH") or 50)  # сообщений DC за один запрос истории при догонке
+DC_BACKFILL_MAX_AGE = int(os.getenv("DC_BACKFILL_MAX_AGE") or 24 * 3600)  # старше — не догоняем (сек)
+TG_URL_PASSTHROUGH = (os.getenv("TG_URL_PASSTHROUGH") or "0") == "1"  # DC→TG: отдавать Telegram ссылки CDN вместо загрузки файлов
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR") or "media_cache"
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE") or 256 * 1024 * 1024)  # сколько байт медиа держать на диске
+MEDIA_CACHE_ITEM_MAX = int(os.getenv("MEDIA_CACHE_ITEM_MAX") or 2 * 1024 * 1024)  # файлы крупнее не кэшируем
+MEDIA_CACHE_ENTRIES = int(os.getenv("MEDIA_CACHE_ENTRIES") or 20000)  # сколько file_id/ссылок помнить
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE") or 2.0)  # первая пауза перед повтором (сек), дальше вдвое больше
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX") or 300)  # пауза между повторами не больше (сек)
+DEAD_CHAT_FAILURES = int(os.getenv("DEAD_CHAT_FAILURES") or 2)  # столько «чат недоступен» подряд — и чат в карантин
+DEAD_CHAT_PROBE_INTERVAL = int(os.getenv("DEAD_CHAT_PROBE_INTERVAL") or 6 * 3600)  # первая перепроверка чата в карантине (сек)
+DEAD_CHAT_PROBE_MAX = int(os.getenv("DEAD_CHAT_PROBE_MAX") or 7 * 24 * 3600)  # дальше — реже, но не реже этого
+LINKS_DB_MAX_AGE = int(os.getenv("LINKS_DB_MAX_AGE") or 180 * 24 * 3600)  # сколько хранить связи в SQLite (сек)
 
 os.makedirs(TMP_DIR, exist_ok=True)
 
+# ───────── PERSISTENCE ─────────
+def atomic_write(path, data):
+    """Записать файл атомарно: временный файл рядом + rename"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class PersistWriter:
+    """Фоновая запись файлов: изменения помечаются, а на диск уходят пачкой из отдельного потока"""
+
+    def __init__(self, interval, max_dirty):
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self._targets = {}  # name -> функция записи
+        self._dirty = {}  # name -> количество изменений с последней записи
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def register(self, name, path, serializer):
+        """Зарегистрировать файл: serializer() возвращает строку для записи"""
+        self._targets[name] = lambda: atomic_write(path, self._snapshot(serializer))
+
+    def register_callback(self, name, write):
+        """Зарегистрировать произвольную запись: write() вызывается из фонового потока"""
+        self._targets[name] = write
+
+    def mark_dirty(self, name):
+        """Пометить файл изменённым (дёшево, вызывается из event loop)"""
+        with self._lock:
+            self._dirty[name] = self._dirty.get(name, 0) + 1
+            pending = sum(self._dirty.values())
+        if pending >= self.max_dirty:
+            self._wake.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="persist-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановить поток и принудительно записать всё несохранённое"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Записать все изменённые файлы"""
+        with self._flush_lock:
+            with self._lock:
+                names = list(self._dirty)
+                self._dirty.clear()
+            for name in names:
+                try:
+                    self._targets[name]()
+                except Exception as e:
+                    print(f"⚠️ Ошибка записи {name}: {e}")
+                    with self._lock:
+                        self._dirty[name] = self._dirty.get(name, 0) + 1
+
+    @staticmethod
+    def _snapshot(serializer):
+        # Event loop может менять dict во время сериализации — просто пробуем ещё раз
+        for _ in range(4):
+            try:
+                return serializer()
+            except RuntimeError:
+                continue
+        return serializer()
+
+persist = PersistWriter(PERSIST_INTERVAL, PERSIST_MAX_DIRTY)
+
+# ───────── SQLITE ─────────
+class SqliteStorage:
+    """Хранилище в SQLite (WAL): пользователи, админы, настройки и связи сообщений.
+    Изменения копятся в очереди и пишутся одной транзакцией из фонового потока"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS users (chat_id TEXT PRIMARY KEY, chat_type TEXT, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS users_chat_type ON users(chat_type);
+        CREATE TABLE IF NOT EXISTS admins (chat_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS allowed_users (chat_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS link_groups (gid INTEGER PRIMARY KEY, origin INTEGER NOT NULL, ts INTEGER NOT NULL, dc_id INTEGER);
+        CREATE INDEX IF NOT EXISTS link_groups_dc ON link_groups(dc_id);
+        CREATE INDEX IF NOT EXISTS link_groups_ts ON link_groups(ts);
+        CREATE TABLE IF NOT EXISTS link_copies (
+            chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, gid INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS link_copies_gid ON link_copies(gid);
+        CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, ts INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS processed_ts ON processed(ts);
+    """
+    LIST_TABLES = {"admins": "admins", "allowed_users": "allowed_users"}  # ключ state -> таблица
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        self._lock = threading.Lock()  # соединение общее для event loop и фонового потока
+        self._pending = []  # [(sql, params), ...] — ждут записи
+        self._pending_lock = threading.Lock()
+        self._written = {}  # что уже лежит в БД (для записи только изменений)
+        for key, value in self.load_settings().items():
+            self._written[key] = frozenset(value) if key in self.LIST_TABLES else json.dumps(value, ensure_ascii=False)
+        self._last_purge = 0.0
+
+    # --- чтение (из event loop, по индексам) ---
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def migrated(self):
+        return bool(self._query("SELECT 1 FROM meta WHERE key = 'json_migrated'"))
+
+    def load_users(self):
+        return {chat_id: json.loads(data) for chat_id, data in self._query("SELECT chat_id, data FROM users")}
+
+    def load_settings(self):
+        settings = {key: json.loads(value) for key, value in self._query("SELECT key, value FROM settings")}
+        for key, table in self.LIST_TABLES.items():
+            settings[key] = [row[0] for row in self._query(f"SELECT chat_id FROM {table}")]
+        return settings
+
+    def load_processed(self, deadline):
+        return self._query("SELECT key, ts FROM processed WHERE ts >= ? ORDER BY ts", (deadline,))
+
+    def max_link_gid(self):
+        return self._query("SELECT COALESCE(MAX(gid), 0) FROM link_groups")[0][0]
+
+    def find_link_group(self, chat_id=None, message_id=None, dc_id=None):
+        """(gid, origin, ts, dc_id, [(chat_id, message_id), ...]) или None"""
+        if dc_id is not None:
+            rows = self._query("SELECT gid, origin, ts, dc_id FROM link_groups WHERE dc_id = ?", (int(dc_id),))
+        else:
+            rows = self._query(
+                "SELECT g.gid, g.origin, g.ts, g.dc_id FROM link_copies c JOIN link_groups g ON g.gid = c.gid "
+                "WHERE c.chat_id = ? AND c.message_id = ?",
+                (int(chat_id), int(message_id))
+            )
+        if not rows:
+            return None
+        gid, origin, ts, found_dc_id = rows[0]
+        copies = self._query("SELECT chat_id, message_id FROM link_copies WHERE gid = ?", (gid,))
+        return gid, origin, ts, found_dc_id, copies
+
+    # --- запись (ставится в очередь, выполняется в flush) ---
+    def queue(self, sql, params=()):
+        with self._pending_lock:
+            self._pending.append((sql, params))
+
+    def queue_user(self, chat_id_str, data):
+        self.queue(
+            "INSERT INTO users (chat_id, chat_type, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET chat_type = excluded.chat_type, data = excluded.data",
+            (chat_id_str, data.get("chat_type"), json.dumps(data, ensure_ascii=False))
+        )
+
+    def queue_link_group(self, group):
+        self.queue(
+            "INSERT INTO link_groups (gid, origin, ts, dc_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(gid) DO UPDATE SET dc_id = excluded.dc_id",
+            (group.gid, group.origin, group.ts, group.dc_id)
+        )
+
+    def queue_link_copy(self, gid, chat_id, message_id):
+        self.queue(
+            "INSERT OR REPLACE INTO link_copies (chat_id, message_id, gid) VALUES (?, ?, ?)",
+            (int(chat_id), int(message_id), gid)
+        )
+
+    def queue_processed(self, key, ts):
+        self.queue("INSERT OR REPLACE INTO processed (key, ts) VALUES (?, ?)", (key, ts))
+
+    def queue_link_drop(self, gid):
+        self.queue("DELETE FROM link_copies WHERE gid = ?", (gid,))
+        self.queue("DELETE FROM link_groups WHERE gid = ?", (gid,))
+
+    def save_settings(self, state_snapshot):
+        """Записать только изменившиеся настройки и строки admins/allowed_users"""
+        for key, value in state_snapshot.items():
+            if key in self.LIST_TABLES:
+                table = self.LIST_TABLES[key]
+                old, new = self._written.get(key, frozenset()), frozenset(value)
+                for chat_id in new - old:
+                    self.queue(f"INSERT OR IGNORE INTO {table} (chat_id) VALUES (?)", (chat_id,))
+                for chat_id in old - new:
+                    self.queue(f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+                self._written[key] = new
+                continue
+            encoded = json.dumps(value, ensure_ascii=False)
+            if self._written.get(key) != encoded:
+                self.queue(
+                    "INSERT INTO settings (key, value) VALUES (?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (key, encoded)
+                )
+                self._written[key] = encoded
+        self.flush()
+
+    def drop_setting(self, key):
+        self.queue("DELETE FROM settings WHERE key = ?", (key,))
+        self._written.pop(key, None)
+
+    def flush(self):
+        """Выполнить накопленные изменения одной транзакцией"""
+        with self._pending_lock:
+            ops, self._pending = self._pending, []
+        if time.time() - self._last_purge > 3600:
+            self._last_purge = time.time()
+            deadline = int(time.time()) - LINKS_DB_MAX_AGE
+            ops.append(("DELETE FROM link_copies WHERE gid IN (SELECT gid FROM link_groups WHERE ts < ?)", (deadline,)))
+            ops.append(("DELETE FROM link_groups WHERE ts < ?", (deadline,)))
+            ops.append(("DELETE FROM processed WHERE ts < ?", (int(time.time()) - DEDUPE_WINDOW,)))
+        if not ops:
+            return
+        with self._lock:
+            try:
+                self._db.execute("BEGIN")
+                for sql, params in ops:
+                    self._db.execute(sql, params)
+                self._db.execute("COMMIT")
+            except:
+                self._db.execute("ROLLBACK")
+                with self._pending_lock:
+                    self._pending[:0] = ops
+                raise
+
+    def migrate(self, users, settings, link_store):
+        """Одноразовый перенос данных из JSON-файлов"""
+        for chat_id_str, data in users.items():
+            self.queue_user(str(chat_id_str), data)
+        for group in link_store.groups():
+            self.queue_link_group(group)
+            for chat_id, ids in group.copies.items():
+                for message_id in ids:
+                    self.queue_link_copy(group.gid, chat_id, message_id)
+        for key, ts in link_store._processed.items():
+            self.queue_processed(key, ts)
+        self.queue("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (str(int(time.time())),))
+        self.save_settings(settings)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+storage = SqliteStorage(DB_FILE) if STORAGE_BACKEND == "sqlite" else None
+
 # ───────── STATE ─────────
 STATE_FILE = "state.json"
 ALL_USERS_FILE = "all_users.json"
+LINKS_FILE = "links.json"
+LINKS_JOURNAL_FILE = "links.jsonl"
 
 # Загружаем всех пользователей (теперь как dict: {chat_id: username})
 all_users = {}  # {chat_id: {"username": "name", "first_name": "name"}}
-if os.path.exists(ALL_USERS_FILE):
+if storage and storage.migrated():
+    all_users = storage.load_users()
+elif os.path.exists(ALL_USERS_FILE):
     try:
         with open(ALL_USERS_FILE, "r", encoding="utf-8") as f:
             content = f.read()
@@ -49,46 +375,66 @@ state = {
     "dc_to_tg_target": "all",  # Куда отправлять из Discord: "bot" (в ЛС бота), "group" (в группу), "all" (везде)
     "admins": [],  # Список админов (как строки)
     "allowed_users": [],  # Список разрешённых пользователей (как строки)
-    "discord_channel_id": DEFAULT_CHANNEL_ID,
-    "reply_map": {}
+    "discord_channel_id": DEFAULT_CHANNEL_ID,  # Канал по умолчанию — для чатов без своей привязки
+    "routes": {},  # Отдельные мосты: {"id канала DC": ["chat_id", ...]}
+    "dc_last_seen": {},  # Последнее увиденное сообщение в канале DC: {"id канала": id сообщения}
+    "quarantine": {}  # Недоступные чаты: {"chat_id": {"since", "error", "probe_in", "probe_at"}}
 }
 
-def save_state():
-    if len(state["reply_map"]) > 3000:
-        keys = list(state["reply_map"].keys())
-        for k in keys[:1500]:
-            state["reply_map"].pop(k, None)
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2, ensure_ascii=False)
-
-def save_all_users():
-    """Сохранить всех пользователей"""
+def _dump_state():
+    return json.dumps(state, indent=2, ensure_ascii=False)
+
+def _dump_all_users():
     # Нормализуем ключи перед сохранением
     normalized = {str(k): v for k, v in all_users.items()}
-    with open(ALL_USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(normalized, f, indent=2, ensure_ascii=False)
+    return json.dumps(normalized, indent=2, ensure_ascii=False)
+
+if storage:
+    # В SQLite пишем только изменившиеся строки
+    persist.register_callback("state", lambda: storage.save_settings(dict(state)))
+    persist.register_callback("all_users", storage.flush)
+else:
+    persist.register("state", STATE_FILE, _dump_state)
+    persist.register("all_users", ALL_USERS_FILE, _dump_all_users)
+
+def save_state():
+    """Пометить состояние для записи (сама запись — в фоне)"""
+    persist.mark_dirty("state")
+
+def save_all_users(chat_id=None):
+    """Сохранить пользователя chat_id (или всех) — запись в фоне"""
+    if storage:
+        for chat_id_str in ([str(chat_id)] if chat_id is not None else list(all_users)):
+            if chat_id_str in all_users:
+                storage.queue_user(chat_id_str, dict(all_users[chat_id_str]))
+    persist.mark_dirty("all_users")
 
 def add_user_to_all(msg):
     """Добавить пользователя в список всех пользователей с именем"""
+    add_chat_to_all(msg.chat, msg.from_user)
+
+def add_chat_to_all(chat, from_user):
+    """Добавить чат в список всех пользователей (from_user — кто написал или добавил бота)"""
     global all_users
-    chat_id = str(msg.chat.id)  # Всегда используем строки
+    chat_id = str(chat.id)  # Всегда используем строки
     if chat_id not in all_users:
         # Для групп используем название группы, для ЛС - имя пользователя
-        if msg.chat.type in ["group", "supergroup"]:
-            display_name = msg.chat.title or f"Chat{chat_id}"
-            username = msg.from_user.username if msg.from_user else None
+        if chat.type in ["group", "supergroup"]:
+            display_name = chat.title or f"Chat{chat_id}"
+            username = from_user.username if from_user else None
         else:
-            display_name = msg.from_user.username or msg.from_user.full_name or "User"
-            username = msg.from_user.username if msg.from_user else None
+            display_name = from_user.username or from_user.full_name or "User"
+            username = from_user.username if from_user else None
 
         all_users[chat_id] = {
             "username": username or display_name,
             "first_name": display_name,
             "last_name": "",
-            "chat_type": msg.chat.type,
-            "chat_title": msg.chat.title if hasattr(msg.chat, 'title') else None
+            "chat_type": chat.type,
+            "chat_title": chat.title if hasattr(chat, 'title') else None
         }
-        save_all_users()
+        routing.update(chat_id, all_users[chat_id])
+        save_all_users(chat_id)
 
 def add_user_by_id(chat_id):
     """Добавить пользователя по ID (без имени, пока он не напишет боту)"""
@@ -100,7 +446,8 @@ def add_user_by_id(chat_id):
             "first_name": f"User{chat_id_str}",
             "last_name": ""
         }
-        save_all_users()
+        routing.update(chat_id_str, all_users[chat_id_str])
+        save_all_users(chat_id_str)
 
 def update_user_info(msg):
     """Обновить информацию о пользователе (если он уже есть в базе)"""
@@ -121,7 +468,8 @@ def update_user_info(msg):
             all_users[chat_id]["last_name"] = ""
             all_users[chat_id]["chat_type"] = msg.chat.type
             all_users[chat_id]["chat_title"] = msg.chat.title if hasattr(msg.chat, 'title') else None
-            save_all_users()
+            routing.update(chat_id, all_users[chat_id])
+            save_all_users(chat_id)
 
 def get_user_display_name(chat_id):
     """Получить отображаемое имя пользователя"""
@@ -131,42 +479,411 @@ def get_user_display_name(chat_id):
         return user.get("first_name") or user.get("username") or f"User{chat_id_str}"
     return f"User{chat_id_str}"
 
+def _apply_loaded_state(loaded):
+    """Применить загруженное состояние и выполнить миграции старых форматов"""
+    state.update(loaded)
+    # Миграция: старый reply_map не знает chat_id — связи по нему восстановить нельзя
+    if state.pop("reply_map", None):
+        print("ℹ️ reply_map устарел и отброшен, связи сообщений теперь в links.json")
+    # Нормализуем admins к строкам
+    state["admins"] = [str(a) for a in state.get("admins", [])]
+    # Нормализуем allowed_users к строкам
+    state["allowed_users"] = [str(u) for u in state.get("allowed_users", [])]
+    # Нормализуем dc_to_tg_target
+    if "dc_to_tg_target" not in state:
+        state["dc_to_tg_target"] = "all"
+    state.setdefault("quarantine", {})
+    state.setdefault("dc_last_seen", {})
+    # Токен webhook позволяет писать в канал — без PERSIST_WEBHOOKS=1 на диске его не держим
+    if not PERSIST_WEBHOOKS and state.pop("webhooks", None) is not None and storage:
+        storage.drop_setting("webhooks")
+    # Нормализуем routes: ключи — id каналов, значения — списки chat_id строками
+    state["routes"] = {str(ch): [str(c) for c in chats] for ch, chats in (state.get("routes") or {}).items() if chats}
+    # Миграция: если есть admin_chat_id, переносим в admins
+    if "admin_chat_id" in loaded and loaded["admin_chat_id"]:
+        admin_id = str(loaded["admin_chat_id"])
+        if admin_id not in state["admins"]:
+            state["admins"].append(admin_id)
+        del state["admin_chat_id"]
+        save_state()
+    # Миграция: если есть tg_chat_id, переносим в admins
+    if "tg_chat_id" in loaded and loaded["tg_chat_id"]:
+        tg_id = str(loaded["tg_chat_id"])
+        if tg_id not in state["admins"]:
+            state["admins"].append(tg_id)
+        if tg_id not in state["allowed_users"]:
+            state["allowed_users"].append(tg_id)
+        del state["tg_chat_id"]
+        save_state()
+    save_state()  # Сохраняем нормализованное состояние
+
 def load_state():
-    """Загрузить состояние из файла"""
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            try:
-                loaded = json.load(f)
-                state.update(loaded)
-                # Нормализуем admins к строкам
-                state["admins"] = [str(a) for a in state.get("admins", [])]
-                # Нормализуем allowed_users к строкам
-                state["allowed_users"] = [str(u) for u in state.get("allowed_users", [])]
-                # Нормализуем dc_to_tg_target
-                if "dc_to_tg_target" not in state:
-                    state["dc_to_tg_target"] = "all"
-                # Миграция: если есть admin_chat_id, переносим в admins
-                if "admin_chat_id" in loaded and loaded["admin_chat_id"]:
-                    admin_id = str(loaded["admin_chat_id"])
-                    if admin_id not in state["admins"]:
-                        state["admins"].append(admin_id)
-                    del state["admin_chat_id"]
-                    save_state()
-                # Миграция: если есть tg_chat_id, переносим в admins
-                if "tg_chat_id" in loaded and loaded["tg_chat_id"]:
-                    tg_id = str(loaded["tg_chat_id"])
-                    if tg_id not in state["admins"]:
-                        state["admins"].append(tg_id)
-                    if tg_id not in state["allowed_users"]:
-                        state["allowed_users"].append(tg_id)
-                    del state["tg_chat_id"]
-                    save_state()
-                save_state()  # Сохраняем нормализованное состояние
-            except Exception as e:
-                print(f"⚠️ Ошибка загрузки state: {e}")
+    """Загрузить состояние из файла (или из SQLite, если данные уже перенесены)"""
+    try:
+        if storage and storage.migrated():
+            _apply_loaded_state(storage.load_settings())
+        elif os.path.exists(STATE_FILE):
+            with open(STATE_FILE, "r", encoding="utf-8") as f:
+                _apply_loaded_state(json.load(f))
+    except Exception as e:
+        print(f"⚠️ Ошибка загрузки state: {e}")
 
 load_state()
 
+# ───────── MESSAGE LINKS ─────────
+def _pack(chat_id, message_id):
+    # message_id в TG < 2^31, поэтому (chat_id, message_id) помещается в один int
+    return (int(chat_id) << 32) | int(message_id)
+
+class LinkGroup:
+    """Одно событие моста: исходное сообщение + все его копии в TG и DC"""
+    __slots__ = ("gid", "origin", "dc_id", "copies", "ts")
+
+    def __init__(self, gid, origin, ts):
+        self.gid = gid
+        self.origin = origin  # откуда пришло сообщение: LinkStore.ORIGIN_TG / ORIGIN_DC
+        self.dc_id = None  # message_id в Discord
+        self.copies = {}  # chat_id (int) -> [message_id, ...]
+        self.ts = ts  # время последнего обращения (для LRU/TTL)
+
+    def tg_message_id(self, chat_id):
+        """Первый message_id этого события в чате (или None)"""
+        ids = self.copies.get(int(chat_id))
+        return ids[0] if ids else None
+
+    def tg_chats(self):
+        return [str(chat_id) for chat_id in self.copies]
+
+class LinkStore:
+    """Связи сообщений (chat_id, message_id) ↔ discord_message_id с индексами в обе стороны.
+    Хранит не больше max_entries копий (событие, разосланное в 300 чатов, — это 300 копий);
+    давно не использованные события вытесняются целиком (LRU + TTL).
+    С storage (SQLite) в памяти только горячие связи, остальные подгружаются по индексу"""
+    ORIGIN_TG = 1
+    ORIGIN_DC = 2
+
+    def __init__(self, max_entries, max_age, storage=None, dedupe_window=DEDUPE_WINDOW, dedupe_max=DEDUPE_MAX):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.storage = storage
+        self.dedupe_window = dedupe_window
+        self.dedupe_max = dedupe_max
+        self._processed = OrderedDict()  # "tg:chat_id:message_id" / "dc:channel_id:message_id" -> ts, от старых к новым
+        self._groups = OrderedDict()  # gid -> LinkGroup, от давно использованных к свежим
+        self._by_tg = {}  # _pack(chat_id, message_id) -> gid
+        self._by_dc = {}  # discord_message_id -> gid
+        self._entries = 0  # сколько копий (chat_id, message_id) во всех группах
+        self.journal = None  # LinkJournal в JSON-режиме
+        self._next_gid = 1
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._groups)
+
+    def stats(self):
+        return {"groups": len(self._groups), "entries": self._entries, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def new_group(self, origin):
+        gid = self._next_gid
+        self._next_gid += 1
+        group = self._groups[gid] = LinkGroup(gid, origin, int(time.time()))
+        self._evict()
+        if self.storage:
+            self.storage.queue_link_group(group)
+        self._changed(["g", gid, origin, group.ts])
+        return gid
+
+    def _changed(self, op):
+        """Записать изменение: в журнал (JSON-режим) и пометить links для PersistWriter"""
+        if self.journal:
+            self.journal.log(op)
+        persist.mark_dirty("links")
+
+    def _evict(self):
+        # Сначала устаревшие (они всегда в начале OrderedDict), потом лишние по числу копий;
+        # самое свежее событие не трогаем, даже если оно одно больше лимита
+        deadline = int(time.time()) - self.max_age
+        while len(self._groups) > 1:
+            gid, group = next(iter(self._groups.items()))
+            if group.ts >= deadline and self._entries <= self.max_entries:
+                break
+            self._forget(gid)
+            self.evictions += 1
+
+    def _touch(self, gid):
+        group = self._groups.get(gid) if gid else None
+        if group is None:
+            self.misses += 1
+            return None
+        now = int(time.time())
+        if group.ts < now - self.max_age:
+            self._forget(gid)
+            self.evictions += 1
+            self.misses += 1
+            return None
+        group.ts = now
+        self._groups.move_to_end(gid)
+        self.hits += 1
+        return group
+
+    def add_tg(self, gid, chat_id, message_id):
+        self.add_copies(gid, [(chat_id, message_id)])
+
+    def add_result(self, gid, result):
+        """Запомнить все копии из FanoutResult"""
+        self.add_copies(gid, [
+            (chat_id_str, message_id)
+            for chat_id_str in result.chats
+            for message_id in result.messages.get(chat_id_str, [])
+        ])
+
+    def add_copies(self, gid, copies):
+        """Запомнить копии [(chat_id, message_id), ...] — одним изменением на всю рассылку"""
+        group = self._groups.get(gid)
+        if group is None or not copies:
+            return
+        flat = []
+        for chat_id, message_id in copies:
+            chat_id, message_id = int(chat_id), int(message_id)
+            if self._add_copy(group, chat_id, message_id) and self.storage:
+                self.storage.queue_link_copy(gid, chat_id, message_id)
+            flat += [chat_id, message_id]
+        self._evict()
+        self._changed(["c", gid, flat])
+
+    def _add_copy(self, group, chat_id, message_id):
+        key = _pack(chat_id, message_id)
+        if key in self._by_tg:
+            return False
+        group.copies.setdefault(chat_id, []).append(message_id)
+        self._by_tg[key] = group.gid
+        self._entries += 1
+        return True
+
+    def set_dc(self, gid, dc_message_id):
+        group = self._groups.get(gid)
+        if group is None:
+            return
+        group.dc_id = int(dc_message_id)
+        self._by_dc[group.dc_id] = gid
+        if self.storage:
+            self.storage.queue_link_group(group)
+        self._changed(["d", gid, group.dc_id])
+
+    def by_tg(self, chat_id, message_id):
+        gid = self._by_tg.get(_pack(chat_id, message_id))
+        if gid is None and self.storage:
+            gid = self._adopt(self.storage.find_link_group(chat_id=chat_id, message_id=message_id))
+        return self._touch(gid)
+
+    def by_dc(self, dc_message_id):
+        gid = self._by_dc.get(int(dc_message_id))
+        if gid is None and self.storage:
+            gid = self._adopt(self.storage.find_link_group(dc_id=dc_message_id))
+        return self._touch(gid)
+
+    def _adopt(self, row, ts=None):
+        """Положить группу (gid, origin, ts, dc_id, [(chat_id, message_id), ...]) в память"""
+        if row is None:
+            return None
+        gid, origin, _, dc_id, copies = row
+        group = self._groups[gid] = LinkGroup(gid, origin, ts if ts is not None else int(time.time()))
+        if dc_id is not None:
+            group.dc_id = dc_id
+            self._by_dc[dc_id] = gid
+        for chat_id, message_id in copies:
+            group.copies.setdefault(chat_id, []).append(message_id)
+            self._by_tg[_pack(chat_id, message_id)] = gid
+            self._entries += 1
+        self._evict()
+        return gid
+
+    def processed(self, source, chat_id, message_id):
+        """Это сообщение уже пересылали? Если нет — отмечаем (проверка и отметка разом, O(1))"""
+        key = f"{source}:{chat_id}:{message_id}"
+        now = int(time.time())
+        self._expire_processed(now)
+        if key in self._processed:
+            return True
+        self._processed[key] = now
+        if self.storage:
+            self.storage.queue_processed(key, now)
+        self._changed(["p", key, now])
+        return False
+
+    def _expire_processed(self, now):
+        deadline = now - self.dedupe_window
+        while self._processed:
+            key, ts = next(iter(self._processed.items()))
+            if ts >= deadline and len(self._processed) < self.dedupe_max:
+                break
+            del self._processed[key]
+
+    def load_processed(self, rows):
+        for key, ts in rows:
+            self._processed[key] = ts
+        self._expire_processed(int(time.time()))
+
+    def groups(self):
+        return list(self._groups.values())
+
+    def drop(self, gid):
+        self._forget(gid)
+        if self.storage:
+            self.storage.queue_link_drop(gid)
+        self._changed(["x", gid])
+
+    def clear(self):
+        self._clear()
+        if self.storage:
+            self.storage.queue("DELETE FROM link_copies")
+            self.storage.queue("DELETE FROM link_groups")
+        self._changed(["clear"])
+
+    def _clear(self):
+        self._groups.clear()
+        self._by_tg.clear()
+        self._by_dc.clear()
+        self._entries = 0
+
+    def apply(self, op):
+        """Повторить изменение из журнала (повтор уже применённого ничего не меняет)"""
+        kind = op[0]
+        if kind == "g":
+            _, gid, origin, ts = op
+            self._next_gid = max(self._next_gid, gid + 1)
+            if gid not in self._groups and ts >= int(time.time()) - self.max_age:
+                self._adopt((gid, origin, ts, None, []), ts=ts)
+        elif kind == "c":
+            group = self._groups.get(op[1])
+            if group:
+                for chat_id, message_id in zip(op[2][::2], op[2][1::2]):
+                    self._add_copy(group, chat_id, message_id)
+                self._evict()
+        elif kind == "d":
+            group = self._groups.get(op[1])
+            if group:
+                group.dc_id = op[2]
+                self._by_dc[group.dc_id] = group.gid
+        elif kind == "x":
+            self._forget(op[1])
+        elif kind == "clear":
+            self._clear()
+        elif kind == "p":
+            self._processed[op[1]] = op[2]
+
+    def _forget(self, gid):
+        group = self._groups.pop(gid, None)
+        if group is None:
+            return
+        if group.dc_id is not None:
+            self._by_dc.pop(group.dc_id, None)
+        for chat_id, ids in group.copies.items():
+            self._entries -= len(ids)
+            for message_id in ids:
+                self._by_tg.pop(_pack(chat_id, message_id), None)
+
+    def dump(self):
+        # Компактный формат: [gid, origin, ts, dc_id, [chat_id, message_id, chat_id, message_id, ...]]
+        rows = []
+        for group in list(self._groups.values()):
+            flat = []
+            for chat_id, ids in list(group.copies.items()):
+                for message_id in ids:
+                    flat += [chat_id, message_id]
+            rows.append([group.gid, group.origin, group.ts, group.dc_id, flat])
+        processed = [[key, ts] for key, ts in list(self._processed.items())]
+        return json.dumps({"next_gid": self._next_gid, "groups": rows, "processed": processed}, separators=(",", ":"))
+
+    def load(self, data):
+        self._next_gid = data.get("next_gid", 1)
+        deadline = int(time.time()) - self.max_age
+        for gid, origin, ts, dc_id, flat in data.get("groups", []):
+            if ts < deadline:
+                continue
+            self._adopt((gid, origin, ts, dc_id, zip(flat[::2], flat[1::2])), ts=ts)
+        self.load_processed(data.get("processed", []))
+
+class LinkJournal:
+    """Связи в JSON-режиме: links.json — снимок, links.jsonl — изменения после него.
+    Сброс дописывает только новые изменения; снимок целиком переписываем, лишь когда журнал
+    перерос его — запись на сообщение не зависит от размера хранилища"""
+    MIN_COMPACT = 1024 * 1024  # журнал меньше этого не сворачиваем
+
+    def __init__(self, path, journal_path, store):
+        self.path = path
+        self.journal_path = journal_path
+        self.store = store
+        self._lines = []
+        self._lock = threading.Lock()
+        self._snapshot_bytes = os.path.getsize(path) if os.path.exists(path) else 0
+        self._journal_bytes = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+
+    def log(self, op):
+        with self._lock:
+            self._lines.append(json.dumps(op, separators=(",", ":")))
+
+    def replay(self):
+        """Применить к загруженному снимку изменения из журнала"""
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    self.store.apply(json.loads(line))
+                except ValueError:
+                    continue  # Недописанная строка при падении
+        self.store.load_processed([])
+
+    def flush(self):
+        """Из потока PersistWriter: дописать журнал или, если он вырос, свернуть в снимок"""
+        with self._lock:
+            lines, self._lines = self._lines, []
+        if self._journal_bytes > max(self._snapshot_bytes, self.MIN_COMPACT):
+            # Снимок снят после того, как забрали lines, — значит, они в нём уже учтены
+            data = PersistWriter._snapshot(self.store.dump)
+            atomic_write(self.path, data)
+            open(self.journal_path, "w").close()
+            self._snapshot_bytes = len(data)
+            self._journal_bytes = 0
+            return
+        if lines:
+            chunk = "".join(line + "\n" for line in lines)
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(chunk)
+            self._journal_bytes += len(chunk)
+
+links = LinkStore(LINKS_MAX_ENTRIES, LINKS_MAX_AGE)
+links_journal = LinkJournal(LINKS_FILE, LINKS_JOURNAL_FILE, links)
+
+if not (storage and storage.migrated()):
+    try:
+        if os.path.exists(LINKS_FILE):
+            with open(LINKS_FILE, "r", encoding="utf-8") as f:
+                links.load(json.load(f))
+        links_journal.replay()
+    except Exception as e:
+        print(f"⚠️ Ошибка загрузки links: {e}")
+
+if storage:
+    # Миграция: однократно переносим JSON-файлы в SQLite, дальше работаем только с БД
+    if not storage.migrated():
+        storage.migrate(all_users, dict(state), links)
+        print(f"✅ Данные перенесены в {DB_FILE}: {len(all_users)} пользователей, {len(links)} связей")
+    links.storage = storage
+    links._next_gid = max(links._next_gid, storage.max_link_gid() + 1)
+    links.load_processed(storage.load_processed(int(time.time()) - DEDUPE_WINDOW))
+    persist.register_callback("links", storage.flush)
+else:
+    links.journal = links_journal
+    persist.register_callback("links", links_journal.flush)
+
+def tg_reply_to(group, chat_id_str):
+    """message_id, на который надо ответить в чате chat_id_str (по группе связей)"""
+    return group.tg_message_id(chat_id_str) if group else None
+
 def is_admin(chat_id):
     """Проверка, является ли пользователь админом"""
     return str(chat_id) in state.get("admins", [])
@@ -207,48 +924,706 @@ def remove_allowed_user(chat_id):
         state["allowed_users"].remove(chat_id_str)
         save_state()
 
-async def send_to_all_users(text, **kwargs):
-    """Отправить сообщение всем пользователям с учётом dc_to_tg_target"""
-    all_chats = get_target_chats()
-    sent_messages = []
-    
-    for chat_id_str in all_chats:
-        try:
-            msg = await bot.send_message(int(chat_id_str), text, **kwargs)
-            sent_messages.append((chat_id_str, msg.message_id))
-        except Exception as e:
-            print(f"Error sending to {chat_id_str}: {e}")
-    
-    return sent_messages
+async def send_to_all_users(text, reply_group=None, channel_id=None, gid=None, **kwargs):
+    """Отправить сообщение всем чатам моста channel_id с учётом dc_to_tg_target
+    (через outbox: при временных ошибках дошлём, копии допишем в группу gid)"""
+    return await outbox.broadcast(
+        get_target_chats(channel_id),
+        "send_message",
+        {"text": text, **kwargs},
+        reply_group=reply_group,
+        gid=gid
+    )
 
-def get_target_chats():
-    """Получить список чатов для отправки с учётом dc_to_tg_target"""
-    all_chats = list(all_users.keys())
-    dc_target = state.get("dc_to_tg_target", "all")
-    result = []
+class RoutingIndex:
+    """Куда рассылать: каждый чат TG относится к одному мосту — своему каналу DC из routes
+    или каналу по умолчанию. Готовый кортеж чатов на каждую пару (канал, режим dc_to_tg_target)
+    пересчитываем только при изменениях"""
+
+    def __init__(self):
+        self._chats = {}  # chat_id_str -> is_group (в порядке добавления)
+        self._routes = {}  # chat_id_str -> id канала DC (только привязанные чаты)
+        self._bridges = {}  # id канала DC -> {chat_id_str}
+        self._targets = {}  # (канал, это канал по умолчанию, режим) -> tuple(chat_id_str)
+
+    def rebuild(self, users, routes):
+        self._chats.clear()
+        self._routes.clear()
+        self._bridges.clear()
+        self._targets.clear()
+        for channel_id, chats in routes.items():
+            for chat_id_str in chats:
+                self.bind(chat_id_str, int(channel_id))
+        for chat_id_str, user in users.items():
+            self.update(chat_id_str, user)
+
+    def update(self, chat_id_str, user):
+        """Учесть нового пользователя или смену типа чата"""
+        if not chat_id_str or chat_id_str in state["quarantine"]:
+            return  # Чаты в карантине в рассылку не попадают
+        is_group = user.get("chat_type", "private") in ["group", "supergroup"]
+        if self._chats.get(chat_id_str) is not is_group:
+            self._chats[chat_id_str] = is_group
+            self._targets.clear()
+
+    def remove(self, chat_id_str):
+        if self._chats.pop(chat_id_str, None) is not None:
+            self._targets.clear()
+
+    def bind(self, chat_id_str, channel_id):
+        """Привязать чат к своему каналу DC"""
+        self.unbind(chat_id_str)
+        self._routes[chat_id_str] = channel_id
+        self._bridges.setdefault(channel_id, set()).add(chat_id_str)
+        self._targets.clear()
+
+    def unbind(self, chat_id_str):
+        """Вернуть чат на канал по умолчанию"""
+        channel_id = self._routes.pop(chat_id_str, None)
+        if channel_id is None:
+            return
+        chats = self._bridges[channel_id]
+        chats.discard(chat_id_str)
+        if not chats:
+            del self._bridges[channel_id]
+        self._targets.clear()
+
+    def channel_for(self, chat_id):
+        """Канал DC, куда пересылать из этого чата"""
+        return self._routes.get(str(chat_id)) or state["discord_channel_id"]
+
+    def route_of(self, chat_id):
+        """Свой канал чата (None — канал по умолчанию)"""
+        return self._routes.get(str(chat_id))
+
+    def bridged(self, channel_id):
+        """Пересылаем ли из этого канала DC"""
+        return channel_id == state["discord_channel_id"] or channel_id in self._bridges
+
+    def channels(self):
+        """Все каналы DC, из которых пересылаем"""
+        return [state["discord_channel_id"], *self._bridges] if state["discord_channel_id"] else list(self._bridges)
+
+    def dump_routes(self):
+        return {str(channel_id): sorted(chats) for channel_id, chats in self._bridges.items()}
+
+    def targets(self, mode, channel_id=None):
+        default = state["discord_channel_id"]
+        channel_id = channel_id or default
+        key = (channel_id, channel_id == default, mode)
+        chats = self._targets.get(key)
+        if chats is None:
+            chats = []
+            for chat_id_str, is_group in self._chats.items():
+                route = self._routes.get(chat_id_str)
+                if route != channel_id and (route is not None or channel_id != default):
+                    continue  # Чат другого моста
+                if mode == "bot" and is_group:
+                    continue  # Пропускаем группы, отправляем только в ЛС
+                if mode == "group" and not is_group:
+                    continue  # Пропускаем ЛС, отправляем только в группы
+                chats.append(chat_id_str)
+            chats = self._targets[key] = tuple(chats)
+        return chats
+
+routing = RoutingIndex()
+routing.rebuild(all_users, state["routes"])
+
+def bind_route(chat_id, channel_id):
+    """Привязать чат TG к каналу DC (отдельный мост)"""
+    routing.bind(str(chat_id), channel_id)
+    state["routes"] = routing.dump_routes()
+    save_state()
 
-    for chat_id_str in all_chats:
-        if not chat_id_str:
-            continue
+def unbind_route(chat_id):
+    routing.unbind(str(chat_id))
+    state["routes"] = routing.dump_routes()
+    save_state()
 
-        # Определяем тип чата
-        user_data = all_users.get(chat_id_str, {})
-        chat_type = user_data.get("chat_type", "private")
-        is_group = chat_type in ["group", "supergroup"]
+def get_target_chats(channel_id=None):
+    """Чаты моста channel_id (None — канала по умолчанию) с учётом dc_to_tg_target;
+    неизменяемый кортеж из индекса"""
+    return routing.targets(state.get("dc_to_tg_target", "all"), channel_id)
+
+# ───────── FAN-OUT ─────────
+class FanoutResult:
+    """Итог рассылки по чатам: какие message_id получены и где были ошибки"""
+
+    def __init__(self, chats):
+        self.chats = list(chats)  # порядок чатов как при запуске рассылки
+        self.messages = {}  # chat_id_str -> [message_id, ...]
+        self.sent = {}  # chat_id_str -> то, что вернула отправка (Message / список Message)
+        self.errors = {}  # chat_id_str -> exception
+
+    def add(self, chat_id_str, sent):
+        """Записать результат отправки (Message, список Message, True или None)"""
+        self.sent[chat_id_str] = sent
+        if sent is None or sent is True:
+            self.messages.setdefault(chat_id_str, [])
+            return
+        items = sent if isinstance(sent, list) else [sent]
+        ids = self.messages.setdefault(chat_id_str, [])
+        ids.extend(m.message_id for m in items if hasattr(m, "message_id"))
+
+    def message_id(self, chat_id_str):
+        """Первый message_id в конкретном чате"""
+        ids = self.messages.get(chat_id_str)
+        return ids[0] if ids else None
+
+    def first(self):
+        """(chat_id_str, message_id) первого успешного чата в порядке рассылки"""
+        for chat_id_str in self.chats:
+            message_id = self.message_id(chat_id_str)
+            if message_id is not None:
+                return chat_id_str, message_id
+        return None
 
-        # Фильтруем по настройке dc_to_tg_target
-        if dc_target == "bot" and is_group:
-            continue  # Пропускаем группы, отправляем только в ЛС
-        elif dc_target == "group" and not is_group:
-            continue  # Пропускаем ЛС, отправляем только в группы
-        # если "all" - отправляем везде
+    def file_id(self):
+        """file_id файла из первой успешной отправки"""
+        first = self.first()
+        return sent_file_id(self.sent.get(first[0])) if first else None
+
+    @property
+    def ok_count(self):
+        return len(self.messages)
+
+    def merge(self, other):
+        """Добавить результаты другой рассылки (по другим чатам)"""
+        self.messages.update(other.messages)
+        self.sent.update(other.sent)
+        self.errors.update(other.errors)
+
+class FanoutEngine:
+    """Параллельная рассылка: разные чаты — одновременно (не больше workers),
+    внутри одного чата — строго по очереди"""
+
+    def __init__(self, workers):
+        self._sem = asyncio.Semaphore(workers)
+        self._lanes = {}  # chat_id_str -> deque[(job, future)]
+
+    def submit(self, chat_id_str, job):
+        """Поставить job (async-функцию без аргументов) в очередь чата"""
+        future = asyncio.get_running_loop().create_future()
+        lane = self._lanes.get(chat_id_str)
+        if lane is None:
+            lane = self._lanes[chat_id_str] = deque()
+            lane.append((job, future))
+            asyncio.create_task(self._drain(chat_id_str, lane))
+        else:
+            lane.append((job, future))
+        return future
+
+    async def _drain(self, chat_id_str, lane):
+        while lane:
+            job, future = lane.popleft()
+            # Лимит чата ждём до того, как занять воркер: пока этот чат «остывает»,
+            # слот отправляет в другие чаты (иначе группы с их 20/мин забивают все воркеры)
+            wait = tg_limiter.chat_delay(chat_id_str)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self._sem:
+                try:
+                    result = await job()
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        del self._lanes[chat_id_str]
+
+    async def broadcast(self, chats, send, exclude=None, label="отправка в TG"):
+        """Вызвать send(chat_id_str) для каждого чата и собрать FanoutResult"""
+        chats = [c for c in chats if c and c != exclude]
+        result = FanoutResult(chats)
+        futures = [self.submit(chat_id_str, lambda c=chat_id_str: send(c)) for chat_id_str in chats]
+        for chat_id_str, outcome in zip(chats, await asyncio.gather(*futures, return_exceptions=True)):
+            if isinstance(outcome, Exception):
+                result.errors[chat_id_str] = outcome
+                print(f"⚠️ Ошибка ({label}) {chat_id_str}: {outcome}")
+            else:
+                result.add(chat_id_str, outcome)
+        return result
 
-        result.append(chat_id_str)
+fanout = FanoutEngine(FANOUT_WORKERS)
 
+def sent_file_id(sent):
+    """file_id файла из отправленного сообщения — чтобы не загружать его повторно"""
+    if isinstance(sent, list):
+        sent = sent[0] if sent else None
+    if sent is None or sent is True:
+        return None
+    if sent.photo:
+        return sent.photo[-1].file_id
+    for media in (sent.document, sent.animation, sent.video, sent.audio, sent.voice, sent.video_note, sent.sticker):
+        if media:
+            return media.file_id
+    return None
+
+# Ошибки про сам файл (плохая ссылка, устаревший file_id): в другом чате будет то же самое
+FILE_ERRORS = (
+    "failed to get http url content", "wrong type of the web page content", "wrong file identifier",
+    "wrong remote file", "wrong file", "file must be non-empty", "image_process_failed",
+    "photo_invalid_dimensions", "too big"
+)
+
+def is_file_error(e):
+    """Telegram не принял сам файл, а не чат"""
+    return isinstance(e, TelegramBadRequest) and any(reason in str(e).lower() for reason in FILE_ERRORS)
+
+async def broadcast_file(chats, send, input_file, exclude=None, label="отправка в TG"):
+    """Разослать файл: загружаем один раз (в первый чат, где получилось),
+    остальным чатам отправляем полученный file_id. send(chat_id_str, media);
+    input_file может быть списком (альбом) — тогда и media будет списком.
+    Если ошибка про сам файл — дальше по чатам не пробуем, пусть вызывающий берёт запасной вариант"""
+    chats = [c for c in chats if c and c != exclude]
+    result = FanoutResult(chats)
+    for i, chat_id_str in enumerate(chats):
+        first = await fanout.broadcast([chat_id_str], lambda c: send(c, input_file), label=label)
+        result.merge(first)
+        error = first.errors.get(chat_id_str)
+        if error is not None and is_file_error(error):
+            for rest_chat in chats[i + 1:]:
+                result.errors[rest_chat] = error
+            break
+        if chat_id_str in first.messages:
+            sent = first.sent.get(chat_id_str)
+            if isinstance(input_file, list):
+                # Альбом: file_id каждого элемента, если Telegram вернул их все
+                sent = sent if isinstance(sent, list) else [sent]
+                file_id = [sent_file_id(m) for m in sent]
+                if len(file_id) != len(input_file) or not all(file_id):
+                    file_id = None
+            else:
+                file_id = sent_file_id(sent)
+            rest = chats[i + 1:]
+            if rest:
+                media = file_id or input_file
+                result.merge(await fanout.broadcast(rest, lambda c: send(c, media), label=label))
+            break
     return result
 
+# ───────── RATE LIMIT ─────────
+class TokenBucket:
+    """Token bucket с резервированием: reserve() сразу говорит, сколько ждать"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def delay(self):
+        """Сколько ждать до свободного токена (не занимая его)"""
+        now = time.monotonic()
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        wait = (1 - tokens) / self.rate if tokens < 1 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        """Заморозить bucket (после RetryAfter от Telegram)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self):
+        return self.tokens >= self.capacity and self.paused_until <= time.monotonic()
+
+class TelegramLimiter:
+    """Общий лимит на бота + отдельный лимит на каждый чат (по chat_type)"""
+    MAX_BUCKETS = 5000
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, max(1.0, TG_GLOBAL_RATE))
+        self._chats = {}  # chat_id_str -> TokenBucket
+
+    def _chat_bucket(self, chat_id):
+        chat_id_str = str(chat_id)
+        bucket = self._chats.get(chat_id_str)
+        if bucket is None:
+            if len(self._chats) >= self.MAX_BUCKETS:
+                # Забываем чаты, которые давно ничего не отправляли
+                for key in [k for k, b in self._chats.items() if b.idle()]:
+                    del self._chats[key]
+            chat_type = all_users.get(chat_id_str, {}).get("chat_type", "private")
+            if chat_type in ["group", "supergroup", "channel"]:
+                bucket = TokenBucket(TG_GROUP_RATE, 3)
+            else:
+                bucket = TokenBucket(TG_PRIVATE_RATE, 3)
+            self._chats[chat_id_str] = bucket
+        return bucket
+
+    async def acquire(self, chat_id):
+        # Сначала ждём свой чат, потом общий лимит — чтобы не занимать общий токен зря
+        wait = self._chat_bucket(chat_id).reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        wait = self.global_bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def chat_delay(self, chat_id):
+        """Сколько чат ещё не может отправлять (токен не занимаем — его возьмёт acquire)"""
+        return self._chat_bucket(chat_id).delay()
+
+    def pause(self, chat_id, seconds):
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            self._chat_bucket(chat_id).pause(seconds)
+
+tg_limiter = TelegramLimiter()
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Лимит для всех send_*/edit_*/delete_* запросов бота + повтор после flood-wait"""
+    LIMITED_PREFIXES = ("Send", "Edit", "Delete", "Copy", "Forward")
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        limited = chat_id is not None and type(method).__name__.startswith(self.LIMITED_PREFIXES)
+        attempt = 0
+        while True:
+            if limited:
+                await tg_limiter.acquire(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > TG_MAX_RETRIES:
+                    raise
+                print(f"⏳ Flood wait {e.retry_after}s ({type(method).__name__} → {chat_id}), попытка {attempt}")
+                tg_limiter.pause(chat_id if limited else None, e.retry_after)
+                if not limited:
+                    await asyncio.sleep(e.retry_after)
+
+# ───────── OUTBOX ─────────
+OUTBOX_FILE = "outbox.jsonl"
+DEAD_LETTER_FILE = "outbox_dead.jsonl"
+
+def is_transient(e):
+    """Временная ошибка (сеть, 5xx, flood-wait, таймаут) — доставку стоит повторить"""
+    if isinstance(e, (TelegramNetworkError, TelegramServerError, TelegramRetryAfter, aiohttp.ClientError, asyncio.TimeoutError, OSError)):
+        return True
+    if isinstance(e, discord.HTTPException):
+        return e.status >= 500 or e.status == 429
+    return False
+
+class Outbox:
+    """Журнал доставок (append-only JSONL): задание пишется до отправки, отметка done — после.
+    Временные ошибки повторяем с растущей (до OUTBOX_RETRY_MAX) паузой без ограничения числа попыток,
+    после перезапуска незавершённое досылаем, безнадёжное уходит в dead-letter файл. Журналим только то, что можно повторить
+    без исходного апдейта: текст и file_id"""
+
+    def __init__(self, path, dead_path):
+        self.path = path
+        self.dead_path = dead_path
+        self._jobs = {}  # id -> задание, в "pending" — кому ещё не доставлено
+        self._lines = []  # строки журнала, ещё не записанные на диск
+        self._dead_lines = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # flush зовут и PersistWriter, и commit
+        self._commit = None  # общая запись для отправок, начавшихся одновременно
+        self._tasks = set()
+        self.retrying = 0
+        self.dead = 0
+
+    def __len__(self):
+        return len(self._jobs)
+
+    # ── журнал ──
+    def _log(self, entry):
+        with self._lock:
+            self._lines.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+        persist.mark_dirty("outbox")
+
+    def flush(self):
+        """Дописать журнал на диск (из потока PersistWriter или из commit)"""
+        with self._flush_lock:
+            with self._lock:
+                lines, self._lines = self._lines, []
+                dead_lines, self._dead_lines = self._dead_lines, []
+            if dead_lines:
+                with open(self.dead_path, "a", encoding="utf-8") as f:
+                    f.write("".join(line + "\n" for line in dead_lines))
+            # Всё доставлено — журнал можно начать заново, а не копить отметки done
+            mode = "a" if self._jobs else "w"
+            with open(self.path, mode, encoding="utf-8") as f:
+                if mode == "a":
+                    f.write("".join(line + "\n" for line in lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+    async def commit(self):
+        """Дождаться, пока записанное в журнал окажется на диске. Отправки, начавшиеся
+        одновременно, ждут один общий fsync"""
+        if self._commit is None:
+            self._commit = asyncio.ensure_future(self._group_commit())
+        await asyncio.shield(self._commit)
+
+    async def _group_commit(self):
+        await asyncio.sleep(0)  # даём соседним отправкам дописать свои задания
+        self._commit = None  # записи, пришедшие дальше, уйдут следующим fsync
+        await asyncio.to_thread(self.flush)
+
+    def load(self):
+        """Прочитать незавершённые задания (после падения) и переписать журнал только с ними"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # Недописанная строка при падении
+                job = self._jobs.get(entry.get("id"))
+                if entry["op"] == "add":
+                    self._jobs[entry["id"]] = entry["job"]
+                elif job:
+                    done = set(entry["to"])
+                    job["pending"] = [c for c in job["pending"] if c not in done]
+                    if not job["pending"]:
+                        del self._jobs[entry["id"]]
+        atomic_write(self.path, "".join(
+            json.dumps({"op": "add", "id": job_id, "job": job}, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for job_id, job in self._jobs.items()
+        ))
+        if self._jobs:
+            print(f"📮 Outbox: {len(self._jobs)} недоставленных заданий, досылаем")
+
+    def _add(self, job):
+        self._jobs[job["id"]] = job
+        self._log({"op": "add", "id": job["id"], "job": job})
+
+    def _done(self, job, targets):
+        """Отметить доставку (повторная отметка ничего не меняет)"""
+        targets = [t for t in targets if t in job["pending"]]
+        job["pending"] = [t for t in job["pending"] if t not in targets]
+        if not job["pending"]:
+            self._jobs.pop(job["id"], None)
+        if targets:
+            self._log({"op": "done", "id": job["id"], "to": targets})
+
+    def _dead(self, job, target, e):
+        print(f"☠️ Outbox: не доставлено {job['kind']} → {target}: {type(e).__name__}: {e}")
+        self.dead += 1
+        with self._lock:
+            self._dead_lines.append(json.dumps(
+                {"ts": int(time.time()), "to": target, "error": f"{type(e).__name__}: {e}", "job": job},
+                ensure_ascii=False
+            ))
+        self._done(job, [target])
+
+    # ── доставка ──
+    async def broadcast(self, chats, method, args, reply_group=None, gid=None, exclude=None, label="отправка в TG"):
+        """fanout.broadcast для bot.<method>(chat_id, **args) или send_input_media (args["media"] — словари
+        из input_media_args): через журнал, с повторами при временных ошибках.
+        Копии из первой попытки возвращаются в FanoutResult, из повторов — сразу пишутся в группу gid"""
+        chats = [c for c in chats if c and c != exclude]
+        if not chats:
+            return FanoutResult([])  # Некому слать — и журналить нечего
+        reply = {}
+        for chat_id_str in chats:
+            reply_to = tg_reply_to(reply_group, chat_id_str)
+            if reply_to:
+                reply[chat_id_str] = reply_to
+        job = {
+            "id": uuid.uuid4().hex, "kind": "tg", "method": method, "args": args,
+            "reply": reply, "gid": gid, "pending": list(chats)
+        }
+        self._add(job)
+        await self.commit()  # Задание на диске до первой отправки — падение его не потеряет
+        result = await fanout.broadcast(chats, lambda c: self._send_tg(job, c), label=label)
+        self._done(job, list(result.messages))
+        for chat_id_str, e in result.errors.items():
+            self._failed(job, chat_id_str, e, 1)
+        return result
+
+    async def post_dc(self, channel_id, payload, gid=None):
+        """send_via_webhook для сообщения без файлов: через журнал, при временной ошибке — повтор в фоне.
+        Канал и webhook ищем уже после записи в журнал: Discord недоступен — дошлём, когда вернётся"""
+        job = {"id": uuid.uuid4().hex, "kind": "dc", "channel": channel_id, "payload": payload, "gid": gid, "pending": ["dc"]}
+        self._add(job)
+        await self.commit()
+        try:
+            if not dc.is_ready():
+                raise ConnectionError("Discord не подключён")
+            sent = await self._send_dc(job)
+        except Exception as e:
+            self._failed(job, "dc", e, 1)
+            raise
+        self._done(job, ["dc"])
+        return sent
+
+    def _send_tg(self, job, chat_id_str):
+        kwargs = dict(job["args"])
+        if chat_id_str in job["reply"]:
+            kwargs["reply_to_message_id"] = job["reply"][chat_id_str]
+        if job["method"] == "send_input_media":
+            # Альбом хранится в журнале словарями — собираем InputMedia обратно
+            items = [_INPUT_MEDIA[item.pop("type")](**item) for item in map(dict, kwargs.pop("media"))]
+            return send_input_media(int(chat_id_str), items, **kwargs)
+        return getattr(bot, job["method"])(int(chat_id_str), **kwargs)
+
+    async def _send_dc(self, job):
+        channel = dc.get_channel(job["channel"]) or await dc.fetch_channel(job["channel"])
+        return await send_via_webhook(channel, **job["payload"])
+
+    def _failed(self, job, target, e, attempt):
+        # Временные ошибки повторяем, пока не доставим (сбой может длиться часами), в dead-letter — только безнадёжное
+        if is_transient(e):
+            delay = min(OUTBOX_RETRY_BASE * 2 ** min(attempt - 1, 20), OUTBOX_RETRY_MAX)
+            self._spawn(self._retry(job, target, attempt, delay))
+        else:
+            self._dead(job, target, e)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _retry(self, job, target, attempt, delay):
+        self.retrying += 1
+        try:
+            await asyncio.sleep(delay)
+            if target not in job["pending"]:
+                return  # Уже доставлено
+            try:
+                if job["kind"] == "dc":
+                    await dc.wait_until_ready()
+                    sent = await self._send_dc(job)
+                    links.set_dc(job["gid"], sent.id)
+                else:
+                    sent = await fanout.submit(target, lambda: self._send_tg(job, target))
+                    result = FanoutResult([target])
+                    result.add(target, sent)
+                    links.add_result(job["gid"], result)
+            except Exception as e:
+                print(f"⚠️ Outbox: повтор {attempt} {job['kind']} → {target}: {type(e).__name__}: {e}")
+                self._failed(job, target, e, attempt + 1)
+                return
+            self._done(job, [target])
+            print(f"📮 Outbox: доставлено с {attempt + 1}-й попытки {job['kind']} → {target}")
+        finally:
+            self.retrying -= 1
+
+    def replay(self):
+        """Дослать задания, не завершённые до перезапуска"""
+        for job in list(self._jobs.values()):
+            for target in list(job["pending"]):
+                self._spawn(self._retry(job, target, 1, 0))
+
+outbox = Outbox(OUTBOX_FILE, DEAD_LETTER_FILE)
+outbox.load()
+persist.register_callback("outbox", outbox.flush)
+
+# ───────── DEAD CHATS ─────────
+def is_dead_chat_error(e):
+    """Чат недоступен не временно: бот заблокирован или удалён из группы, чат удалён или не найден"""
+    if isinstance(e, TelegramForbiddenError):
+        return True
+    if isinstance(e, TelegramBadRequest):
+        text = str(e).lower()
+        return any(reason in text for reason in ("chat not found", "peer_id_invalid", "user is deactivated", "bot was kicked"))
+    return False
+
+class ChatHealth:
+    """Недоставки по чатам: после DEAD_CHAT_FAILURES ошибок «чат недоступен» подряд чат уходит
+    в карантин (убираем из рассылки), время от времени проверяем его снова. Сетевые ошибки не считаем"""
+
+    def __init__(self, threshold, probe_interval, probe_max):
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.probe_max = probe_max
+        self._failures = {}  # chat_id_str -> сколько раз подряд «чат недоступен»
+
+    def ok(self, chat_id):
+        """Чат живой: отправка прошла или из него пришло сообщение"""
+        chat_id_str = str(chat_id)
+        self._failures.pop(chat_id_str, None)
+        if chat_id_str in state["quarantine"]:
+            self.release(chat_id_str)
+
+    def failed(self, chat_id, e):
+        if not is_dead_chat_error(e):
+            return
+        chat_id_str = str(chat_id)
+        entry = state["quarantine"].get(chat_id_str)
+        if entry:
+            entry["error"] = f"{type(e).__name__}: {e}"[:200]
+            return
+        failures = self._failures[chat_id_str] = self._failures.get(chat_id_str, 0) + 1
+        if failures >= self.threshold:
+            self.quarantine(chat_id_str, f"{type(e).__name__}: {e}")
+
+    def quarantine(self, chat_id_str, reason):
+        if chat_id_str in state["quarantine"]:
+            return
+        now = int(time.time())
+        state["quarantine"][chat_id_str] = {
+            "since": now,
+            "error": reason[:200],
+            "probe_in": self.probe_interval,
+            "probe_at": now + self.probe_interval
+        }
+        self._failures.pop(chat_id_str, None)
+        routing.remove(chat_id_str)
+        save_state()
+        print(f"🚫 Чат {chat_id_str} в карантине: {reason}")
+
+    def release(self, chat_id_str):
+        state["quarantine"].pop(chat_id_str, None)
+        if chat_id_str in all_users:
+            routing.update(chat_id_str, all_users[chat_id_str])
+        save_state()
+        print(f"✅ Чат {chat_id_str} снова доступен")
+
+    async def prober(self, interval=60):
+        """Перепроверять чаты в карантине: send_chat_action ничего не оставляет в чате"""
+        while True:
+            await asyncio.sleep(interval)
+            now = int(time.time())
+            for chat_id_str, entry in list(state["quarantine"].items()):
+                if entry["probe_at"] > now:
+                    continue
+                try:
+                    await bot.send_chat_action(int(chat_id_str), "typing")
+                except Exception as e:
+                    if chat_id_str in state["quarantine"]:
+                        if is_dead_chat_error(e):
+                            entry["probe_in"] = min(entry["probe_in"] * 2, self.probe_max)
+                        entry["probe_at"] = now + entry["probe_in"]
+                        save_state()
+                # Удачную отправку отметит ChatHealthMiddleware — чат вернётся в рассылку
+
+chat_health = ChatHealth(DEAD_CHAT_FAILURES, DEAD_CHAT_PROBE_INTERVAL, DEAD_CHAT_PROBE_MAX)
+
+class ChatHealthMiddleware(BaseRequestMiddleware):
+    """Отмечает в chat_health удачные и неудачные отправки в чаты"""
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(RateLimitMiddleware.LIMITED_PREFIXES):
+            return await make_request(bot, method)
+        try:
+            result = await make_request(bot, method)
+        except Exception as e:
+            chat_health.failed(chat_id, e)
+            raise
+        chat_health.ok(chat_id)
+        return result
+
 # ───────── TELEGRAM ─────────
 bot = Bot(TG_TOKEN)
+bot.session.middleware(ChatHealthMiddleware())
+bot.session.middleware(RateLimitMiddleware())
 dp = Dispatcher()
 router = Router()
 dp.include_router(router)
@@ -278,6 +1653,7 @@ async def start(msg: Message):
     add_user_to_all(msg)
     # Или обновляем информацию если пользователь уже есть
     update_user_info(msg)
+    chat_health.ok(msg.chat.id)
 
     # Первый пользователь становится админом
     if not state.get("admins"):
@@ -292,7 +1668,7 @@ async def start(msg: Message):
         state["enabled"] = True
         state["dnd"] = False
         state["discord_channel_id"] = DEFAULT_CHANNEL_ID
-        state["reply_map"] = {}
+        links.clear()
         save_state()
         await msg.answer(
             f"🚀 **Мост TG ↔ DC**\n\n"
@@ -347,6 +1723,7 @@ async def toggle_dc_target(call: CallbackQuery):
     else:
         state["dc_to_tg_target"] = "all"
     save_state()
+    routing.targets(state["dc_to_tg_target"])  # кортеж для нового режима готовим сразу
     
     dc_target_text = {"bot": "📨 DC→ЛС", "group": "📨 DC→Группа", "all": "📨 DC→Везде"}[state["dc_to_tg_target"]]
     
@@ -395,7 +1772,9 @@ async def status_check(call: CallbackQuery):
         f"DC→: {dc_target_text}\n"
         f"Канал: {state['discord_channel_id']}\n"
         f"Админов: {len(state.get('admins', []))}\n"
-        f"Пользователей: {len(all_users)}",
+        f"Пользователей: {len(all_users)}\n"
+        f"Связей: {len(links)} (вытеснено {links.evictions})\n"
+        f"Загрузки: {downloads.active}, {downloads.bytes_in_flight // (1024 * 1024)} MB",
         show_alert=True
     )
 
@@ -406,44 +1785,93 @@ async def set_channel_req(call: CallbackQuery):
         return
 
     try:
-        guild = dc.get_guild(GUILD_ID)
-        if not guild:
+        if not dc.guilds:
             await call.answer("❌ Сервер не найден", show_alert=True)
             return
+        await show_channel_menu(call)
+    except Exception as e:
+        await call.answer(f"❌ Ошибка: {e}", show_alert=True)
+    await call.answer()
 
-        # Получаем все текстовые каналы
-        channels = [ch for ch in guild.text_channels if ch.permissions_for(guild.me).send_messages]
-        channels.sort(key=lambda x: x.name)
+def dc_channel_name(channel_id):
+    """Имя канала DC (с сервером, если бот на нескольких)"""
+    channel = dc.get_channel(channel_id) if channel_id else None
+    if not channel:
+        return "???"
+    return f"{channel.name} ({channel.guild.name})" if len(dc.guilds) > 1 else channel.name
+
+async def show_channel_menu(call):
+    """Меню каналов: #канал — канал по умолчанию, 🔗 — отдельный мост для этого чата.
+    Каналы со всех серверов бота, сначала — с DISCORD_GUILD_ID"""
+    # Получаем все текстовые каналы
+    channels = [
+        ch for guild in dc.guilds for ch in guild.text_channels
+        if ch.permissions_for(guild.me).send_messages
+    ]
+    channels.sort(key=lambda x: (x.guild.id != GUILD_ID, x.guild.name, x.name))
+
+    kb = []
+    for ch in channels[:20]:  # Максимум 20 каналов
+        kb.append([
+            InlineKeyboardButton(text=f"#{dc_channel_name(ch.id)}", callback_data=f"ch_{ch.id}"),
+            InlineKeyboardButton(text="🔗 Этот чат", callback_data=f"bind_{ch.id}")
+        ])
+
+    chat_route = routing.route_of(call.message.chat.id)
+    if chat_route:
+        kb.append([InlineKeyboardButton(text="❌ Отвязать этот чат", callback_data="unbind")])
+    kb.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="set_channel")])
+    kb.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back")])
+
+    current_ch = state.get("discord_channel_id")
+    current_name = dc_channel_name(current_ch)
+    if chat_route:
+        route_name = dc_channel_name(chat_route)
+        chat_text = f"`#{route_name}` (`{chat_route}`)"
+    else:
+        chat_text = "канал по умолчанию"
 
-        kb = []
-        row = []
-        for ch in channels[:20]:  # Максимум 20 каналов
-            row.append(InlineKeyboardButton(text=f"#{ch.name}", callback_data=f"ch_{ch.id}"))
-            if len(row) == 1:  # По одному в ряд
-                kb.append(row)
-                row = []
-        if row:
-            kb.append(row)
+    try:
+        await call.message.edit_text(
+            f"📡 **Выберите канал Discord**\n\n"
+            f"По умолчанию: `#{current_name}` (`{current_ch}`)\n"
+            f"Этот чат: {chat_text}\n"
+            f"Отдельных мостов: {len(state.get('routes', {}))}\n\n"
+            f"Доступно каналов: {len(channels)}",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
+            parse_mode="Markdown"
+        )
+    except:
+        pass
 
-        kb.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="set_channel")])
-        kb.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back")])
+@router.callback_query(F.data.regexp(r"^bind_\d+$"))
+async def bind_channel(call: CallbackQuery):
+    if not is_admin(call.from_user.id):
+        await call.answer("⛔ Только для админа", show_alert=True)
+        return
 
-        current_ch = state.get("discord_channel_id")
-        current_name = guild.get_channel(current_ch).name if guild.get_channel(current_ch) else "???"
+    channel_id = int(call.data.replace("bind_", ""))
+    bind_route(call.message.chat.id, channel_id)
 
-        try:
-            await call.message.edit_text(
-                f"📡 **Выберите канал Discord**\n\n"
-                f"Текущий: `#{current_name}` (`{current_ch}`)\n\n"
-                f"Доступно каналов: {len(channels)}",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=kb),
-                parse_mode="Markdown"
-            )
-        except:
-            pass
+    try:
+        await show_channel_menu(call)
+        await call.answer(f"🔗 Этот чат ↔ #{dc_channel_name(channel_id)}")
+    except Exception as e:
+        await call.answer(f"❌ Ошибка: {e}", show_alert=True)
+
+@router.callback_query(F.data == "unbind")
+async def unbind_channel(call: CallbackQuery):
+    if not is_admin(call.from_user.id):
+        await call.answer("⛔ Только для админа", show_alert=True)
+        return
+
+    unbind_route(call.message.chat.id)
+
+    try:
+        await show_channel_menu(call)
+        await call.answer("Этот чат снова на канале по умолчанию")
     except Exception as e:
         await call.answer(f"❌ Ошибка: {e}", show_alert=True)
-    await call.answer()
 
 @router.callback_query(F.data.regexp(r"^ch_\d+$"))
 async def select_channel(call: CallbackQuery):
@@ -452,13 +1880,13 @@ async def select_channel(call: CallbackQuery):
         return
 
     channel_id = int(call.data.replace("ch_", ""))
+    invalidate_webhook(state.get("discord_channel_id"))
+    invalidate_webhook(channel_id)
     state["discord_channel_id"] = channel_id
     save_state()
 
     try:
-        guild = dc.get_guild(GUILD_ID)
-        channel = guild.get_channel(channel_id)
-        channel_name = channel.name if channel else "???"
+        channel_name = dc_channel_name(channel_id)
 
         await call.answer(f"✅ Канал: #{channel_name}", show_alert=False)
         
@@ -476,6 +1904,14 @@ async def select_channel(call: CallbackQuery):
     except Exception as e:
         await call.answer(f"❌ Ошибка: {e}", show_alert=True)
 
+def quarantine_text():
+    """Блок меню пользователей: чаты в карантине"""
+    quarantine = state.get("quarantine", {})
+    if not quarantine:
+        return ""
+    lines = [f"• {uid} — {get_user_display_name(uid)} ({entry['error'][:60]})" for uid, entry in quarantine.items()]
+    return f"🚫 Недоступны ({len(quarantine)}):\n" + "\n".join(lines) + "\n\n"
+
 def users_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔄 Обновить", callback_data="users_refresh")],
@@ -522,6 +1958,7 @@ async def users_menu(call: CallbackQuery):
             f"👥 Управление пользователями\n\n"
             f"👑 Админы ({len(admin_ids)}):\n" + "\n".join(admins_list) + "\n\n"
             f"👤 Пользователи ({users_count}):\n" + ("\n".join(users_items) if users_items else "—") + "\n\n"
+            + quarantine_text() +
             f"➕ Добавить админа: +ID\n"
             f"➖ Удалить админа: -ID\n"
             f"➕ Добавить пользователя: ID\n"
@@ -551,7 +1988,7 @@ async def users_refresh(call: CallbackQuery):
                     all_users[admin_id_str]["username"] = new_username
                     all_users[admin_id_str]["first_name"] = new_first_name
                     all_users[admin_id_str]["last_name"] = user.last_name or ""
-                    save_all_users()
+                    save_all_users(admin_id_str)
             except Exception as e:
                 pass
 
@@ -576,6 +2013,7 @@ async def users_refresh(call: CallbackQuery):
             f"👥 Управление пользователями\n\n"
             f"👑 Админы ({len(admin_ids)}):\n" + "\n".join(admins_list) + "\n\n"
             f"👤 Пользователи ({users_count}):\n" + ("\n".join(users_items) if users_items else "—") + "\n\n"
+            + quarantine_text() +
             f"➕ Добавить админа: +ID\n"
             f"➖ Удалить админа: -ID\n"
             f"➕ Добавить пользователя: ID\n"
@@ -603,6 +2041,23 @@ async def go_back(call: CallbackQuery):
         pass
     await call.answer()
 
+@router.my_chat_member()
+async def bot_membership(update: ChatMemberUpdated):
+    """Бота добавили, удалили из группы или заблокировали в ЛС — сразу правим рассылку"""
+    # Каналы TG мостом не обслуживаются: бота сделали админом канала — не начинаем туда рассылать
+    if update.chat.type not in ["private", "group", "supergroup"]:
+        return
+    member = update.new_chat_member
+    chat_id_str = str(update.chat.id)
+    if member.status in ("kicked", "left") or (member.status == "restricted" and not member.is_member):
+        if chat_id_str in all_users:
+            reason = "бот заблокирован" if update.chat.type == "private" else "бот удалён из чата"
+            chat_health.quarantine(chat_id_str, reason)
+        return
+    # member / administrator / creator / restricted, но в чате — чат снова доступен
+    add_chat_to_all(update.chat, update.from_user)
+    chat_health.ok(chat_id_str)
+
 @router.message(F.text.regexp(r"^-\d+$"))
 async def remove_admin_or_user(msg: Message):
     if not is_admin(msg.chat.id):
@@ -643,18 +2098,559 @@ async def add_user(msg: Message):
     await msg.answer(f"✅ Пользователь `{user_id_str}` добавлен", parse_mode="Markdown")
 
 # ───────── WEBHOOK ─────────
+webhook_cache = {}  # channel_id -> Webhook
+
 async def get_webhook(channel):
+    """Webhook канала: из кэша, из сохранённых id/token или через Discord API"""
+    webhook = webhook_cache.get(channel.id)
+    if webhook:
+        return webhook
+
+    saved = state.get("webhooks", {}).get(str(channel.id)) if PERSIST_WEBHOOKS else None
+    if saved:
+        webhook = Webhook.partial(saved["id"], saved["token"], client=dc)
+        webhook_cache[channel.id] = webhook
+        return webhook
+
     try:
+        webhook = None
         webhooks = await channel.webhooks()
         for wh in webhooks:
-            if wh.name == "Bridge":
-                return wh
-        return await channel.create_webhook(name="Bridge")
+            if wh.name == "Bridge" and wh.token:
+                webhook = wh
+                break
+        if not webhook:
+            webhook = await channel.create_webhook(name="Bridge")
     except Exception as e:
+        if is_transient(e):
+            raise  # Сеть или 5xx у Discord — пусть вызывающий (outbox) повторит позже
         print(f"❌ Не удалось создать/найти webhook: {e}")
         return None
 
+    webhook_cache[channel.id] = webhook
+    if PERSIST_WEBHOOKS:
+        state.setdefault("webhooks", {})[str(channel.id)] = {"id": webhook.id, "token": webhook.token}
+        save_state()
+    return webhook
+
+def invalidate_webhook(channel_id):
+    """Забыть webhook канала (удалён, нет прав или сменился канал)"""
+    webhook_cache.pop(channel_id, None)
+    if state.get("webhooks", {}).pop(str(channel_id), None):
+        save_state()
+
+def webhook_gone(e):
+    """Ошибка Discord означает, что webhook больше не работает"""
+    # 10015 — Unknown Webhook, 50027 — Invalid Webhook Token
+    return isinstance(e, discord.Forbidden) or getattr(e, "code", None) in (10015, 50027)
+
+async def send_via_webhook(channel, **payload):
+    """Отправить через webhook; если webhook пропал — пересоздать и повторить (без файлов)"""
+    webhook = await get_webhook(channel)
+    if not webhook:
+        raise RuntimeError("webhook недоступен")
+    try:
+        return await webhook.send(**payload)
+    except discord.HTTPException as e:
+        if not webhook_gone(e):
+            raise
+        invalidate_webhook(channel.id)
+        # Файлы уже закрыты после первой попытки — повторять можно только текст
+        if "file" in payload or "files" in payload:
+            raise
+        webhook = await get_webhook(channel)
+        if not webhook:
+            raise
+        return await webhook.send(**payload)
+
+# ───────── AVATARS ─────────
+class AvatarCache:
+    """Кэш avatar_url с TTL: помним и отсутствие фото, параллельные запросы одного id склеиваем"""
+
+    def __init__(self, ttl, negative_ttl, max_size):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (expires_at, url | None)
+        self._inflight = {}  # key -> Future
+
+    async def get(self, key, fetch):
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry and entry[0] > now:
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        future = self._inflight.get(key)
+        if future:
+            return await asyncio.shield(future)
+
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        url = None
+        try:
+            url = await fetch()
+            ttl = self.ttl if url else self.negative_ttl
+            self._entries[key] = (time.monotonic() + ttl, url)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        except Exception as e:
+            # Ошибку сети не кэшируем — в следующий раз попробуем снова
+            print(f"⚠️ Аватар {key}: {e}")
+        finally:
+            del self._inflight[key]
+            future.set_result(url)
+        return url
+
+avatar_cache = AvatarCache(AVATAR_TTL, AVATAR_NEGATIVE_TTL, AVATAR_CACHE_SIZE)
+
+async def _file_url(file_id):
+    img = await bot.get_file(file_id)
+    return f"https://api.telegram.org/file/bot{TG_TOKEN}/{img.file_path}"
+
+async def _user_avatar(user_id):
+    ups = await bot.get_user_profile_photos(user_id, limit=1)
+    if ups.total_count > 0:
+        return await _file_url(ups.photos[0][-1].file_id)
+    return None
+
+async def _chat_avatar(chat):
+    # В апдейтах photo у sender_chat обычно нет — берём из get_chat
+    photo = chat.photo or (await bot.get_chat(chat.id)).photo
+    if photo and photo.big_file_id:
+        return await _file_url(photo.big_file_id)
+    return None
+
+async def get_avatar_url(msg, is_group):
+    """avatar_url для webhook: фото канала/группы (анонимно) или профиля отправителя"""
+    if is_group and msg.sender_chat:
+        return await avatar_cache.get(("chat", msg.sender_chat.id), lambda: _chat_avatar(msg.sender_chat))
+    if msg.from_user:
+        return await avatar_cache.get(("user", msg.from_user.id), lambda: _user_avatar(msg.from_user.id))
+    return None
+
+# ───────── MEDIA ─────────
+class DownloadManager:
+    """Скачивания медиа: не больше concurrency одновременно и не больше budget байт
+    в памяти/TMP_DIR (бронь держится до MediaBlob.close); уборщик чистит осиротевшие файлы.
+    Несколько файлов одного сообщения бронируем разом через acquire — иначе два альбома,
+    каждый с частью бюджета, ждали бы друг друга вечно"""
+
+    def __init__(self, directory, concurrency, budget, max_age):
+        self.directory = directory
+        self.budget = budget
+        self.max_age = max_age
+        self._slots = asyncio.Semaphore(concurrency)
+        self._waiters = []
+        self._paths = set()  # файлы, которые ещё используются
+        self.bytes_in_flight = 0
+        self.active = 0
+        self.downloaded = 0
+        self.removed = 0
+
+    def temp_path(self, filename):
+        """Уникальный путь в TMP_DIR для одной загрузки"""
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex}_{os.path.basename(filename)}")
+        self._paths.add(path)
+        return path
+
+    async def acquire(self, size):
+        """Занять size байт бюджета (вернуть — release). Файл больше всего бюджета пропускаем,
+        но только когда остальные закончили"""
+        while self.bytes_in_flight and self.bytes_in_flight + size > self.budget:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self.bytes_in_flight += size
+        return size
+
+    async def run(self, size, download, prepaid=False):
+        """Выполнить download() (возвращает MediaBlob), когда есть свободный слот и место в бюджете.
+        prepaid — место уже занято вызывающим через acquire"""
+        size = size or 0
+        held = 0 if prepaid else await self.acquire(size)
+        try:
+            async with self._slots:
+                self.active += 1
+                try:
+                    blob = await download()
+                finally:
+                    self.active -= 1
+        except:
+            self.release(held)
+            raise
+        # Размер мог быть неизвестен заранее — бронируем фактический (сверх оплаченного — отдельно)
+        actual = blob.size()
+        reserved = max(actual - size, 0) if prepaid else actual
+        self.bytes_in_flight += reserved - held
+        self.downloaded += actual
+        blob.reserved = reserved
+        return blob
+
+    def release(self, size, path=None):
+        self.bytes_in_flight -= size
+        self._paths.discard(path)
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def sweep(self):
+        """Удалить из TMP_DIR файлы, которые никто не использует и которые старше max_age"""
+        deadline = time.time() - self.max_age
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.is_file() and entry.path not in self._paths and entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+                    self.removed += 1
+            except OSError:
+                pass
+
+    async def janitor(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.removed
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"⚠️ Уборка {self.directory}: {e}")
+            if self.removed > removed:
+                print(f"🧹 {self.directory}: удалено {self.removed - removed} старых файлов")
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "bytes_in_flight": self.bytes_in_flight,
+            "downloaded": self.downloaded,
+            "removed": self.removed,
+        }
+
+downloads = DownloadManager(TMP_DIR, DOWNLOAD_CONCURRENCY, DOWNLOAD_BUDGET, TMP_MAX_AGE)
+
+class MediaBlob:
+    """Файл для пересылки между TG и DC: небольшие держим в памяти,
+    крупнее MEDIA_SPOOL_THRESHOLD — во временном файле с уникальным именем"""
+
+    def __init__(self, filename, data=None, path=None):
+        self.filename = filename
+        self.data = data
+        self.path = path
+        self.reserved = 0  # сколько байт бюджета downloads занято этим файлом
+
+    def size(self):
+        if self.path:
+            return os.path.getsize(self.path)
+        return len(self.data or b"")
+
+    @classmethod
+    async def from_telegram(cls, file_id, filename=None, size=None, prepaid=False):
+        """Скачать файл Telegram; filename=None — имя берётся из file_path"""
+        async def download():
+            file_info = await bot.get_file(file_id)
+            name = filename or os.path.basename(file_info.file_path)
+            if (size or file_info.file_size or 0) > MEDIA_SPOOL_THRESHOLD:
+                path = downloads.temp_path(name)
+                blob = cls(name, path=path)
+                try:
+                    await bot.download_file(file_info.file_path, path)
+                except:
+                    blob.close()
+                    raise
+                return blob
+            buffer = await bot.download_file(file_info.file_path)
+            return cls(name, data=buffer.getvalue())
+        return await downloads.run(size, download, prepaid)
+
+    @classmethod
+    async def from_attachment(cls, att, prepaid=False):
+        """Скачать вложение Discord"""
+        async def download():
+            if att.size > MEDIA_SPOOL_THRESHOLD:
+                blob = cls(att.filename, path=downloads.temp_path(att.filename))
+                try:
+                    await att.save(blob.path)
+                except:
+                    blob.close()
+                    raise
+                return blob
+            return cls(att.filename, data=await att.read())
+        return await downloads.run(att.size, download, prepaid)
+
+    def discord_file(self):
+        if self.path:
+            return File(self.path, filename=self.filename)
+        return File(BytesIO(self.data), filename=self.filename)
+
+    def tg_input(self):
+        if self.path:
+            return FSInputFile(self.path, filename=self.filename)
+        return BufferedInputFile(self.data, filename=self.filename)
+
+    def close(self):
+        self.data = None
+        if self.path and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except:
+                pass
+        if self.reserved or self.path:
+            downloads.release(self.reserved, self.path)
+            self.reserved = 0
+        self.path = None
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+class MediaCache:
+    """Кэш медиа по file_unique_id (TG) и id стикера (DC) — то, что пересылают снова и снова:
+    небольшие файлы лежат на диске, вытесняются по LRU; запоминаем file_id в TG, чтобы повторно не загружать"""
+
+    def __init__(self, directory, max_bytes, item_max, max_entries):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.item_max = item_max
+        self.max_entries = max_entries
+        self.index_file = os.path.join(directory, "index.json")
+        self._entries = OrderedDict()  # key -> {"file", "size", "tg_file_id"}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def tg_file_id(self, key):
+        entry = self.get(key)
+        return entry.get("tg_file_id") if entry else None
+
+    def remember(self, key, tg_file_id=None):
+        """Запомнить file_id, под которым файл уже загружен в TG (key=None — не кэшируем)"""
+        if not key or not tg_file_id:
+            return
+        entry = self._entries.setdefault(key, {})
+        self._entries.move_to_end(key)
+        entry["tg_file_id"] = tg_file_id
+        self._evict()
+        persist.mark_dirty("media")
+
+    def forget_tg(self, key):
+        """file_id больше не принимается Telegram — в следующий раз загрузим заново"""
+        entry = self._entries.get(key)
+        if entry and entry.pop("tg_file_id", None):
+            persist.mark_dirty("media")
+
+    async def blob(self, key, fetch):
+        """MediaBlob из кэша; при промахе fetch() скачивает файл, небольшие сохраняем на диск"""
+        entry = self.get(key)
+        if entry and entry.get("file"):
+            try:
+                data = await asyncio.to_thread(_read_file, os.path.join(self.directory, entry["file"]))
+                self.hits += 1
+                return MediaBlob(entry.get("name") or entry["file"], data=data)
+            except OSError:
+                self._drop_file(entry)
+        self.misses += 1
+        blob = await fetch()
+        if blob.data is not None and len(blob.data) <= self.item_max:
+            name = hashlib.sha1(key.encode()).hexdigest()
+            try:
+                await asyncio.to_thread(_write_file, os.path.join(self.directory, name), blob.data)
+            except OSError as e:
+                print(f"⚠️ Кэш медиа: {e}")
+                return blob
+            entry = self._entries.setdefault(key, {})
+            self._entries.move_to_end(key)
+            self._drop_file(entry)
+            entry.update(file=name, name=blob.filename, size=len(blob.data))
+            self.bytes += entry["size"]
+            self._evict()
+            persist.mark_dirty("media")
+        return blob
+
+    def _drop_file(self, entry):
+        name = entry.pop("file", None)
+        self.bytes -= entry.pop("size", 0)
+        entry.pop("name", None)
+        if name:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._entries and (self.bytes > self.max_bytes or len(self._entries) > self.max_entries):
+            _, entry = self._entries.popitem(last=False)
+            self._drop_file(entry)
+
+    def dump(self):
+        return json.dumps(list(self._entries.items()), ensure_ascii=False, separators=(",", ":"))
+
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                for key, entry in json.load(f):
+                    if entry.get("file") and not os.path.exists(os.path.join(self.directory, entry["file"])):
+                        entry.pop("file")
+                        entry.pop("size", None)
+                        entry.pop("name", None)
+                    self._entries[key] = entry
+                    self.bytes += entry.get("size", 0)
+            self._evict()
+        except Exception as e:
+            print(f"⚠️ Ошибка загрузки кэша медиа: {e}")
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_SIZE, MEDIA_CACHE_ITEM_MAX, MEDIA_CACHE_ENTRIES)
+media_cache.load()
+persist.register("media", media_cache.index_file, media_cache.dump)
+
+_SINGLE_SEND = {
+    InputMediaPhoto: ("send_photo", "photo"),
+    InputMediaVideo: ("send_video", "video"),
+    InputMediaAudio: ("send_audio", "audio"),
+    InputMediaDocument: ("send_document", "document"),
+}
+
+_INPUT_MEDIA = {cls.model_fields["type"].default: cls for cls in _SINGLE_SEND}
+
+def input_media_args(items):
+    """InputMedia → словари для журнала outbox (пустые поля не пишем)"""
+    return [{**item.model_dump(mode="json", exclude_unset=True), "type": item.type} for item in items]
+
+def send_input_media(chat_id, items, **kwargs):
+    """Отправить список InputMedia: несколько — одним send_media_group, один — обычным send_*
+    (альбом из одного элемента Telegram не принимает)"""
+    if len(items) == 1:
+        item = items[0]
+        method, field = _SINGLE_SEND[type(item)]
+        return getattr(bot, method)(
+            chat_id, **{field: item.media}, caption=item.caption, parse_mode=item.parse_mode, **kwargs
+        )
+    return bot.send_media_group(chat_id, media=items, **kwargs)
+
+def _delivered(result):
+    """Хоть один чат получил сообщение (или рассылать было некому)"""
+    return bool(result.messages or not result.errors)
+
+async def broadcast_media(key, chats, send, get_blob, exclude=None, url=None):
+    """broadcast_file с кэшем: если файл уже загружали в TG — рассылаем по file_id без скачивания;
+    url — ссылка, по которой Telegram может скачать файл сам (TG_URL_PASSTHROUGH);
+    get_blob() вызывается только при промахе и возвращает MediaBlob"""
+    cached_id = media_cache.tg_file_id(key)
+    if cached_id:
+        result = await broadcast_file(chats, send, cached_id, exclude=exclude)
+        if _delivered(result):
+            return result
+        # file_id не принят ни одним чатом — загружаем файл заново
+        media_cache.forget_tg(key)
+    if url and TG_URL_PASSTHROUGH:
+        result = await broadcast_file(chats, send, url, exclude=exclude)
+        if _delivered(result):
+            media_cache.remember(key, tg_file_id=result.file_id())
+            return result
+        print(f"⚠️ Telegram не скачал файл по ссылке, загружаем сами: {key}")
+    blob = await get_blob()
+    result = await broadcast_file(chats, send, blob.tg_input(), exclude=exclude)
+    media_cache.remember(key, tg_file_id=result.file_id())
+    return result
+
+async def broadcast_media_group(chats, items, send, exclude=None, size=0):
+    """Альбом через кэш: items — [(key или None — не кэшировать, InputMedia-класс, get_blob, url, kwargs)], send(chat_id_str, [InputMedia]).
+    Загружаем файлы один раз, дальше (и в следующие разы) — по file_id; url — как в broadcast_media.
+    size — сколько байт займут все файлы: в бюджете загрузок бронируем разом, get_blob качают с prepaid"""
+    def send_sources(chat_id_str, sources):
+        return send(chat_id_str, [kind(media=src, **kw) for (_, kind, _, _, kw), src in zip(items, sources)])
+
+    def remember(result):
+        first = result.first()
+        if first:
+            sent = result.sent.get(first[0])
+            for (key, _, _, _, _), m in zip(items, sent if isinstance(sent, list) else [sent]):
+                media_cache.remember(key, tg_file_id=sent_file_id(m))
+
+    cached = [media_cache.tg_file_id(key) for key, _, _, _, _ in items]
+    if all(cached):
+        result = await broadcast_file(chats, send_sources, cached, exclude=exclude)
+        if _delivered(result):
+            return result
+        for key, _, _, _, _ in items:
+            media_cache.forget_tg(key)
+        cached = [None] * len(items)
+
+    urls = [url if TG_URL_PASSTHROUGH else None for _, _, _, url, _ in items]
+    if all(file_id or url for file_id, url in zip(cached, urls)):
+        result = await broadcast_file(chats, send_sources, [file_id or url for file_id, url in zip(cached, urls)], exclude=exclude)
+        if _delivered(result):
+            remember(result)
+            return result
+        print(f"⚠️ Telegram не скачал альбом по ссылкам, загружаем сами: {len(items)} файлов")
+
+    reserved = await downloads.acquire(size)
+    try:
+        sources = [file_id or (await get_blob()).tg_input() for file_id, (_, _, get_blob, _, _) in zip(cached, items)]
+        result = await broadcast_file(chats, send_sources, sources, exclude=exclude)
+    finally:
+        downloads.release(reserved)
+    remember(result)
+    return result
+
+def dc_upload_limit(guild):
+    """Сколько байт можно переслать из TG в DC: лимит сервера (зависит от буста) и лимит getFile"""
+    return min(guild.filesize_limit, TG_DOWNLOAD_LIMIT)
+
+def size_mb(size):
+    return f"{size / (1024 * 1024):.0f} MB"
+
+def sticker_ext(sticker):
+    """Расширение файла для стикера Telegram"""
+    if sticker.is_video:
+        return "webm"
+    if sticker.is_animated:
+        return "tgs"
+    if sticker.type == "png":
+        return "png"
+    if sticker.type == "gif":
+        return "gif"
+    return "webp"
+
 # ───────── TG → DC: новое сообщение ─────────
+def tg_sender(msg):
+    """(is_group, имя отправителя, заголовок для копий в TG)"""
+    is_group = msg.chat.type in ["group", "supergroup"]
+
+    # Для групп показываем название группы и имя отправителя
+    if is_group:
+        chat_title = msg.chat.title or f"Chat{msg.chat.id}"
+        sender_name = msg.from_user.full_name if msg.from_user else "Unknown"
+        # Если это от имени канала/группы (анонимный админ)
+        if msg.sender_chat:
+            sender_name = msg.sender_chat.title or "Anonymous"
+        tg_header = f"<b>[TG | {chat_title} | {sender_name}]</b>"
+    else:
+        sender_name = msg.from_user.full_name or "Unknown" if msg.from_user else "Unknown"
+        tg_header = f"<b>[TG | {sender_name}]</b>"
+    return is_group, sender_name, tg_header
+
+async def bridge_leg(coro, label):
+    """Одна из параллельных частей пересылки: ошибку только логируем, чтобы не мешать другой"""
+    try:
+        await coro
+    except Exception as e:
+        print(f"❌ {label}: {type(e).__name__}: {e}")
+
 @router.message()
 async def tg_to_dc(msg: Message):
     # Добавляем пользователя в список всех (если это новый пользователь)
@@ -662,6 +2658,9 @@ async def tg_to_dc(msg: Message):
     # Обновляем информацию о пользователе (если изменилось имя)
     update_user_info(msg)
 
+    # Чат прислал сообщение — значит, он точно доступен
+    chat_health.ok(msg.chat.id)
+
     # Проверяем доступ
     if not is_allowed(msg.chat.id):
         return
@@ -672,23 +2671,21 @@ async def tg_to_dc(msg: Message):
     if msg.text and msg.text.startswith("/"):
         return
 
-    path = None
+    # После падения Telegram присылает необработанные апдейты заново — второй раз не пересылаем
+    if links.processed("tg", msg.chat.id, msg.message_id):
+        return
+
+    # Части альбома приходят отдельными апдейтами — собираем и отправляем одним сообщением
+    if msg.media_group_id:
+        albums.add(msg)
+        return
+
+    blob = None
+    media_key = None
     file_to_send = None
 
     # Определяем тип чата и имя отправителя
-    is_group = msg.chat.type in ["group", "supergroup"]
-    
-    # Для групп показываем название группы и имя отправителя
-    if is_group:
-        chat_title = msg.chat.title or f"Chat{msg.chat.id}"
-        sender_name = msg.from_user.full_name if msg.from_user else "Unknown"
-        # Если это от имени канала/группы (анонимный админ)
-        if msg.sender_chat:
-            sender_name = msg.sender_chat.title or "Anonymous"
-        tg_header = f"<b>[TG | {chat_title} | {sender_name}]</b>"
-    else:
-        sender_name = msg.from_user.full_name or "Unknown" if msg.from_user else "Unknown"
-        tg_header = f"<b>[TG | {sender_name}]</b>"
+    is_group, sender_name, tg_header = tg_sender(msg)
 
     # Получаем контент
     content = (msg.text or msg.caption or "").strip()[:2000]
@@ -697,100 +2694,52 @@ async def tg_to_dc(msg: Message):
     else:
         content_with_header = tg_header
 
+    # Мост этого чата: свой канал DC или канал по умолчанию — рассылаем только по его чатам
+    dc_channel_id = routing.channel_for(msg.chat.id)
     # Отправляем сообщение всем пользователям Telegram (кроме отправителя)
-    all_chats = get_target_chats()
+    all_chats = get_target_chats(dc_channel_id)
     sender_chat_id = str(msg.chat.id)  # Преобразуем к строке
     print(f"TG->TG: {len(all_chats)} чатов, отправитель: {sender_chat_id}, чаты: {all_chats}")
-    sent_tg_messages = {}  # chat_id -> message_id
-    first_tg_msg_id = None  # ID первого отправленного сообщения для ответов
 
-    # Если это ответ на сообщение — находим ID для reply
-    reply_to_msg_id = None
+    # Если это ответ на сообщение — находим его группу связей,
+    # чтобы в каждом чате ответить на свою копию
+    reply_group = None
     if msg.reply_to_message:
-        # Ищем в reply_map ID сообщения Discord (для ссылки)
-        # и используем первый TG message_id для reply
-        orig_msg_id = str(msg.reply_to_message.message_id)
-        # Проверяем, есть ли связь с DC
-        dc_id = state["reply_map"].get(orig_msg_id)
-        if dc_id:
-            # Это сообщение из DC — ищем соответствующий TG message_id
-            # reply_map хранит: dc_id -> tg_msg_id (первый)
-            reply_to_msg_id = state["reply_map"].get(f"tg_{dc_id}")
-        if not reply_to_msg_id:
-            # Это сообщение из TG — используем как есть
-            reply_to_msg_id = orig_msg_id
-
-    for chat_id_str in all_chats:
-        if chat_id_str == sender_chat_id:
-            print(f"  Пропускаем отправителя {sender_chat_id}")
-            continue  # Не отправляем самому себе
-        try:
-            if not (msg.photo or msg.document or msg.video or msg.animation or msg.voice or msg.audio or msg.sticker or msg.video_note):
-                # Только текст
-                sent = await bot.send_message(
-                    int(chat_id_str),
-                    content_with_header,
-                    reply_to_message_id=int(reply_to_msg_id) if reply_to_msg_id else None,
-                    parse_mode="HTML"
-                )
-                sent_tg_messages[chat_id_str] = sent.message_id
-                if first_tg_msg_id is None:
-                    first_tg_msg_id = sent.message_id
-                print(f"  Отправлено в {chat_id_str}: {sent.message_id}")
-            else:
-                print(f"  Медиа, отправка позже в {chat_id_str}")
-        except Exception as e:
-            print(f"  Не удалось отправить в TG {chat_id_str}: {e}")
+        reply_group = links.by_tg(msg.chat.id, msg.reply_to_message.message_id)
+
+    # Группа связей этого сообщения: исходник + копии во всех чатах + DC
+    gid = links.new_group(LinkStore.ORIGIN_TG)
+    links.add_tg(gid, msg.chat.id, msg.message_id)
 
-    # Если это только текст — отправляем в Discord
     if not (msg.photo or msg.document or msg.video or msg.animation or msg.voice or msg.audio or msg.sticker or msg.video_note):
-        try:
-            guild = dc.get_guild(GUILD_ID)
-            if not guild:
-                return
-            channel = guild.get_channel(state["discord_channel_id"])
-            if not channel:
-                return
+        # Только текст — рассылаем по всем чатам параллельно (кроме отправителя)
+        async def text_to_tg():
+            result = await outbox.broadcast(
+                all_chats,
+                "send_message",
+                {"text": content_with_header, "parse_mode": "HTML"},
+                reply_group=reply_group,
+                gid=gid,
+                exclude=sender_chat_id
+            )
+            links.add_result(gid, result)
+            print(f"  Отправлено в {result.ok_count} чатов, ошибок: {len(result.errors)}")
 
+        # Discord не ждёт рассылки по TG: обе части идут одновременно,
+        # связи дописываются в группу по мере готовности
+        tg_leg = asyncio.create_task(bridge_leg(text_to_tg(), "TG→TG"))
+        try:
             # Аватар пользователя (для групп - фото профиля пользователя, для каналов - фото канала)
-            avatar_url = None
-            try:
-                if is_group:
-                    # Для групп - аватар пользователя
-                    if msg.from_user:
-                        ups = await bot.get_user_profile_photos(msg.from_user.id, limit=1)
-                        if ups.total_count > 0:
-                            img = await bot.get_file(ups.photos[0][-1].file_id)
-                            avatar_url = f"https://api.telegram.org/file/bot{TG_TOKEN}/{img.file_path}"
-                    elif msg.sender_chat and msg.sender_chat.photo:
-                        # Аватар канала/группы
-                        photo = msg.sender_chat.photo
-                        if photo.big_file_id:
-                            img = await bot.get_file(photo.big_file_id)
-                            avatar_url = f"https://api.telegram.org/file/bot{TG_TOKEN}/{img.file_path}"
-                else:
-                    # Для ЛС - аватар пользователя
-                    if msg.from_user:
-                        ups = await bot.get_user_profile_photos(msg.from_user.id, limit=1)
-                        if ups.total_count > 0:
-                            img = await bot.get_file(ups.photos[0][-1].file_id)
-                            avatar_url = f"https://api.telegram.org/file/bot{TG_TOKEN}/{img.file_path}"
-            except:
-                pass
+            avatar_url = await get_avatar_url(msg, is_group)
 
-            # Reply на сообщение из Discord
-            if msg.reply_to_message:
-                dc_reply_id = state["reply_map"].get(str(msg.reply_to_message.message_id))
-                if dc_reply_id:
-                    # Добавляем ссылку на сообщение в контент
-                    reply_link = f"https://discord.com/channels/{GUILD_ID}/{channel.id}/{dc_reply_id}"
-                    content = f"⤴️ [В ответ]({reply_link})\n{content}"
-
-            # Обычная отправка через webhook
-            webhook = await get_webhook(channel)
-            if not webhook:
-                return
+            # Reply на сообщение из Discord (ссылку можно собрать, только если канал уже известен)
+            channel = dc.get_channel(dc_channel_id)
+            if reply_group and reply_group.dc_id and channel:
+                # Добавляем ссылку на сообщение в контент
+                reply_link = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{reply_group.dc_id}"
+                content = f"⤴️ [В ответ]({reply_link})\n{content}"
 
+            # Обычная отправка через webhook — канал и webhook outbox найдёт сам, после записи в журнал
             payload = {
                 "username": sender_name[:32],
                 "wait": True,
@@ -800,30 +2749,20 @@ async def tg_to_dc(msg: Message):
             if avatar_url:
                 payload["avatar_url"] = avatar_url
 
-            sent = await webhook.send(**payload)
+            sent = await outbox.post_dc(dc_channel_id, payload, gid)
             # Сохраняем связь: TG msg <-> DC msg
-            state["reply_map"][str(msg.message_id)] = str(sent.id)
-            state["reply_map"][str(sent.id)] = str(msg.message_id)
-            # Сохраняем первый TG message_id для ответов из DC
-            if first_tg_msg_id:
-                state["reply_map"][f"tg_{sent.id}"] = str(first_tg_msg_id)
-            save_state()
+            links.set_dc(gid, sent.id)
             print(f"TG→DC ok: {msg.message_id} → {sent.id}")
         except Exception as e:
             print(f"❌ TG→DC: {type(e).__name__}: {e}")
+        finally:
+            await tg_leg
         return
 
     # Если есть медиа — продолжаем стандартную обработку
-    # СНАЧАЛА отправляем всем TG, потом в Discord (чтобы сохранить reply_map правильно)
-
+    # Рассылка по TG и отправка в Discord идут одновременно
+    tg_leg = None
     try:
-        guild = dc.get_guild(GUILD_ID)
-        if not guild:
-            return
-        channel = guild.get_channel(state["discord_channel_id"])
-        if not channel:
-            return
-
         content = (msg.text or msg.caption or "").strip()[:2000]
 
         # Определяем тип медиа
@@ -838,118 +2777,72 @@ async def tg_to_dc(msg: Message):
         is_poll = bool(msg.poll)  # голосование
 
         # СНАЧАЛА: Отправляем медиа всем пользователям Telegram (кроме отправителя)
-        # Чтобы получить first_tg_msg_id для reply_map
-        first_tg_msg_id = None
-        all_chats = get_target_chats()
+        all_chats = get_target_chats(dc_channel_id)
         sender_chat_id = str(msg.chat.id)
 
-        for chat_id_str in all_chats:
-            if chat_id_str == sender_chat_id:
-                continue
-            try:
-                sent_media_msg_id = None
-                # Стикеры — скачиваем и отправляем как файл
-                if is_sticker:
-                    sticker = msg.sticker
-                    file_info = await bot.get_file(sticker.file_id)
-                    if sticker.is_video:
-                        ext = "webm"
-                    elif sticker.is_animated:
-                        ext = "tgs"
-                    elif sticker.type == "gif":
-                        ext = "gif"
-                    else:
-                        ext = "webp"
-                    path = os.path.join(TMP_DIR, f"st_copy_{sticker.file_id}.{ext}")
-                    await bot.download_file(file_info.file_path, path)
-                    sent = await bot.send_document(
-                        int(chat_id_str),
-                        FSInputFile(path),
-                        caption=f"{tg_header}\nСтикер" if not content else f"{tg_header}\n{content}",
-                        parse_mode="HTML"
-                    )
-                    sent_media_msg_id = sent.message_id
-                    if os.path.exists(path):
-                        os.remove(path)
-                # Кружочки (video note)
-                elif is_video_note:
-                    file_info = await bot.get_file(msg.video_note.file_id)
-                    path = os.path.join(TMP_DIR, f"vn_copy_{msg.video_note.file_id}.mp4")
-                    await bot.download_file(file_info.file_path, path)
-                    sent = await bot.send_video_note(
-                        chat_id,
-                        FSInputFile(path)
-                    )
-                    sent_media_msg_id = sent.message_id
-                    if os.path.exists(path):
-                        os.remove(path)
-                # Голосовые сообщения
-                elif is_voice:
-                    file_info = await bot.get_file(msg.voice.file_id)
-                    ext = msg.voice.mime_type.split('/')[-1] if msg.voice.mime_type else "ogg"
-                    path = os.path.join(TMP_DIR, f"vc_copy_{msg.voice.file_id}.{ext}")
-                    await bot.download_file(file_info.file_path, path)
-                    sent = await bot.send_voice(
-                        chat_id,
-                        FSInputFile(path),
-                        caption=f"{tg_header}\n{content}" if content else tg_header,
-                        parse_mode="HTML"
-                    )
-                    sent_media_msg_id = sent.message_id
-                    if os.path.exists(path):
-                        os.remove(path)
-                # Фото
-                elif is_photo:
-                    sent = await bot.send_photo(
-                        chat_id,
-                        photo=msg.photo[-1].file_id,
-                        caption=f"{tg_header}\n{content}" if content else tg_header,
-                        parse_mode="HTML"
-                    )
-                    sent_media_msg_id = sent.message_id
-                # Видео
-                elif is_video:
-                    sent = await bot.send_video(
-                        chat_id,
-                        video=msg.video.file_id,
-                        caption=f"{tg_header}\n{content}" if content else tg_header,
-                        parse_mode="HTML"
-                    )
-                    sent_media_msg_id = sent.message_id
-                # GIF (анимация)
-                elif is_animation:
-                    sent = await bot.send_animation(
-                        chat_id,
-                        animation=msg.animation.file_id,
-                        caption=f"{tg_header}\n{content}" if content else tg_header,
-                        parse_mode="HTML"
-                    )
-                    sent_media_msg_id = sent.message_id
-                # Аудио
-                elif is_audio:
-                    sent = await bot.send_audio(
-                        chat_id,
-                        audio=msg.audio.file_id,
-                        caption=f"{tg_header}\n{content}" if content else tg_header,
-                        parse_mode="HTML"
-                    )
-                    sent_media_msg_id = sent.message_id
-                # Документы
-                elif is_document:
-                    sent = await bot.send_document(
-                        chat_id,
-                        document=msg.document.file_id,
-                        caption=f"{tg_header}\n{content}" if content else tg_header,
-                        parse_mode="HTML"
-                    )
-                    sent_media_msg_id = sent.message_id
-                
-                if first_tg_msg_id is None and sent_media_msg_id:
-                    first_tg_msg_id = sent_media_msg_id
-            except Exception as e:
-                print(f"⚠️ Не удалось отправить медиа в TG {chat_id}: {e}")
+        # Стикер скачиваем один раз (или берём из кэша): эта же копия потом уйдёт в Discord
+        if is_sticker:
+            sticker = msg.sticker
+            ext = sticker_ext(sticker)
+            media_key = f"tg:{sticker.file_unique_id}"
+            blob = await media_cache.blob(
+                media_key,
+                lambda: MediaBlob.from_telegram(sticker.file_id, f"sticker.{ext}", sticker.file_size)
+            )
+
+        # Всё, кроме стикера, пересылаем по file_id — такую отправку можно журналить и повторять
+        caption_args = {"caption": f"{tg_header}\n{content}" if content else tg_header, "parse_mode": "HTML"}
+        tg_method = None
+        # Кружочки (video note) — file_id можно переиспользовать как есть
+        if is_video_note:
+            tg_method, tg_args = "send_video_note", {"video_note": msg.video_note.file_id}
+        # Голосовые сообщения
+        elif is_voice:
+            tg_method, tg_args = "send_voice", {"voice": msg.voice.file_id, **caption_args}
+        # Фото
+        elif is_photo:
+            tg_method, tg_args = "send_photo", {"photo": msg.photo[-1].file_id, **caption_args}
+        # Видео
+        elif is_video:
+            tg_method, tg_args = "send_video", {"video": msg.video.file_id, **caption_args}
+        # GIF (анимация)
+        elif is_animation:
+            tg_method, tg_args = "send_animation", {"animation": msg.animation.file_id, **caption_args}
+        # Аудио
+        elif is_audio:
+            tg_method, tg_args = "send_audio", {"audio": msg.audio.file_id, **caption_args}
+        # Документы
+        elif is_document:
+            tg_method, tg_args = "send_document", {"document": msg.document.file_id, **caption_args}
+
+        async def media_to_tg(sticker_file, sticker_key):
+            if is_sticker:
+                # Стикер нельзя отправить документом по его file_id — загружаем файл один раз,
+                # остальным чатам уходит file_id получившегося документа (его же помним в кэше)
+                send_sticker = lambda chat_id_str, media: bot.send_document(
+                    int(chat_id_str),
+                    media,
+                    caption=f"{tg_header}\nСтикер" if not content else f"{tg_header}\n{content}",
+                    parse_mode="HTML"
+                )
+                async def sticker_blob():
+                    return sticker_file
+                result = await broadcast_media(sticker_key, all_chats, send_sticker, sticker_blob, exclude=sender_chat_id)
+            elif tg_method:
+                result = await outbox.broadcast(all_chats, tg_method, tg_args, gid=gid, exclude=sender_chat_id)
+            else:
+                return
+            links.add_result(gid, result)
+
+        tg_leg = asyncio.create_task(bridge_leg(media_to_tg(blob, media_key), "TG→TG"))
+
+        # Discord — не дожидаясь рассылки по TG (и не мешая ей, если Discord недоступен)
+        channel = dc.get_channel(dc_channel_id)
+        if not channel:
+            return
+        # Проверяем до скачивания: файл, который DC не примет, не качаем вовсе
+        upload_limit = dc_upload_limit(channel.guild)
 
-        # Теперь отправляем в Discord
         webhook = await get_webhook(channel)
         if not webhook:
             return
@@ -986,13 +2879,8 @@ async def tg_to_dc(msg: Message):
                     "poll": discord_poll
                 }
 
-                sent = await webhook.send(**payload)
-                state["reply_map"][str(msg.message_id)] = str(sent.id)
-                state["reply_map"][str(sent.id)] = str(msg.message_id)
-                if first_tg_msg_id:
-                    state["reply_map"][f"tg_{sent.id}"] = str(first_tg_msg_id)
-                state["reply_map"][f"poll_{msg.message_id}"] = "tg"
-                save_state()
+                sent = await send_via_webhook(channel, **payload)
+                links.set_dc(gid, sent.id)
                 print(f"TG→DC poll ok: {msg.message_id} → {sent.id}")
                 return
             except Exception as e:
@@ -1005,70 +2893,57 @@ async def tg_to_dc(msg: Message):
                     "wait": True,
                     "content": results_text
                 }
-                sent = await webhook.send(**payload)
-                state["reply_map"][str(msg.message_id)] = str(sent.id)
-                state["reply_map"][str(sent.id)] = str(msg.message_id)
-                if first_tg_msg_id:
-                    state["reply_map"][f"tg_{sent.id}"] = str(first_tg_msg_id)
-                state["reply_map"][f"poll_{msg.message_id}"] = "tg"
-                save_state()
+                sent = await outbox.post_dc(channel.id, payload, gid)
+                links.set_dc(gid, sent.id)
                 print(f"TG→DC poll (text) ok: {msg.message_id} → {sent.id}")
                 return
 
         if is_sticker:
             sticker = msg.sticker
-            if sticker.file_size and sticker.file_size > MAX_FILE_SIZE:
-                dc_content = "Стикер > 8 MB"
+            if sticker.file_size and sticker.file_size > upload_limit:
+                dc_content = f"Стикер > {size_mb(upload_limit)}"
             else:
-                file_info = await bot.get_file(sticker.file_id)
-                if sticker.is_video:
-                    ext = "webm"
-                elif sticker.is_animated:
-                    ext = "tgs"
-                elif sticker.type == "png":
-                    ext = "png"
-                elif sticker.type == "gif":
-                    ext = "gif"
-                else:
-                    ext = "webp"
-
-                path = os.path.join(TMP_DIR, f"st_{sticker.file_id}.{ext}")
-                await bot.download_file(file_info.file_path, path)
-                file_to_send = File(path, filename=f"sticker.{ext}")
+                # Уже скачан для TG — используем ту же копию
+                file_to_send = blob.discord_file()
                 if not dc_content or dc_content.startswith("Стикер"):
                     dc_content = None
 
         elif is_video_note:
             vn = msg.video_note
-            if vn.file_size and vn.file_size > MAX_FILE_SIZE:
-                dc_content = "Кружочек > 8 MB"
+            if vn.file_size and vn.file_size > upload_limit:
+                dc_content = f"Кружочек > {size_mb(upload_limit)}"
             else:
-                file_info = await bot.get_file(vn.file_id)
-                path = os.path.join(TMP_DIR, f"vn_{vn.file_id}.mp4")
-                await bot.download_file(file_info.file_path, path)
-                file_to_send = File(path, filename="video_note.mp4")
+                media_key = f"tg:{vn.file_unique_id}"
+                blob = await media_cache.blob(
+                    media_key,
+                    lambda: MediaBlob.from_telegram(vn.file_id, "video_note.mp4", vn.file_size)
+                )
+                file_to_send = blob.discord_file()
 
         elif is_voice:
             voice = msg.voice
-            if voice.file_size and voice.file_size > MAX_FILE_SIZE:
-                dc_content = "Голосовое > 8 MB"
+            if voice.file_size and voice.file_size > upload_limit:
+                dc_content = f"Голосовое > {size_mb(upload_limit)}"
             else:
-                file_info = await bot.get_file(voice.file_id)
                 ext = voice.mime_type.split('/')[-1] if voice.mime_type else "ogg"
-                path = os.path.join(TMP_DIR, f"vc_{voice.file_id}.{ext}")
-                await bot.download_file(file_info.file_path, path)
-                file_to_send = File(path, filename=f"voice.{ext}")
+                media_key = f"tg:{voice.file_unique_id}"
+                blob = await media_cache.blob(
+                    media_key,
+                    lambda: MediaBlob.from_telegram(voice.file_id, f"voice.{ext}", voice.file_size)
+                )
+                file_to_send = blob.discord_file()
 
         elif is_photo or is_document or is_video or is_animation or is_audio:
             media = msg.photo[-1] if is_photo else (msg.document or msg.video or msg.animation or msg.audio)
-            if media.file_size and media.file_size > MAX_FILE_SIZE:
-                dc_content = "Файл > 8 MB"
+            if media.file_size and media.file_size > upload_limit:
+                dc_content = f"Файл > {size_mb(upload_limit)}"
             else:
-                file_info = await bot.get_file(media.file_id)
-                ext = file_info.file_path.split('.')[-1] or "bin"
-                path = os.path.join(TMP_DIR, f"f_{media.file_id}.{ext}")
-                await bot.download_file(file_info.file_path, path)
-                file_to_send = File(path)
+                media_key = f"tg:{media.file_unique_id}"
+                blob = await media_cache.blob(
+                    media_key,
+                    lambda: MediaBlob.from_telegram(media.file_id, getattr(media, "file_name", None), media.file_size)
+                )
+                file_to_send = blob.discord_file()
 
         if not dc_content and not file_to_send:
             dc_content = "…"
@@ -1084,46 +2959,180 @@ async def tg_to_dc(msg: Message):
         if file_to_send:
             payload["file"] = file_to_send
 
-        try:
-            # Аватар для медиа (аналогично тексту)
-            if is_group:
-                if msg.from_user:
-                    ups = await bot.get_user_profile_photos(msg.from_user.id, limit=1)
-                    if ups.total_count > 0:
-                        img = await bot.get_file(ups.photos[0][-1].file_id)
-                        payload["avatar_url"] = f"https://api.telegram.org/file/bot{TG_TOKEN}/{img.file_path}"
-                elif msg.sender_chat and msg.sender_chat.photo:
-                    photo = msg.sender_chat.photo
-                    if photo.big_file_id:
-                        img = await bot.get_file(photo.big_file_id)
-                        payload["avatar_url"] = f"https://api.telegram.org/file/bot{TG_TOKEN}/{img.file_path}"
-            else:
-                if msg.from_user:
-                    ups = await bot.get_user_profile_photos(msg.from_user.id, limit=1)
-                    if ups.total_count > 0:
-                        img = await bot.get_file(ups.photos[0][-1].file_id)
-                        payload["avatar_url"] = f"https://api.telegram.org/file/bot{TG_TOKEN}/{img.file_path}"
-        except:
-            pass
+        # Аватар для медиа (аналогично тексту)
+        avatar_url = await get_avatar_url(msg, is_group)
+        if avatar_url:
+            payload["avatar_url"] = avatar_url
 
-        sent = await webhook.send(**payload)
+        sent = await send_via_webhook(channel, **payload)
 
-        state["reply_map"][str(msg.message_id)] = str(sent.id)
-        state["reply_map"][str(sent.id)] = str(msg.message_id)
-        if first_tg_msg_id:
-            state["reply_map"][f"tg_{sent.id}"] = str(first_tg_msg_id)
-        save_state()
+        links.set_dc(gid, sent.id)
 
         print(f"TG→DC ok: {msg.message_id} → {sent.id} {'(стикер)' if is_sticker else ''}")
 
     except Exception as e:
         print(f"❌ TG→DC: {type(e).__name__}: {e}")
     finally:
-        if path and os.path.exists(path):
-            try:
-                os.remove(path)
-            except:
-                pass
+        # Стикер ещё может загружаться в TG — закрываем файл только после рассылки
+        if tg_leg:
+            await tg_leg
+        if blob:
+            blob.close()
+
+# ───────── TG → DC: альбомы ─────────
+class AlbumCollector:
+    """Собирает части альбома (media_group_id) и отдаёт их обработчику одним списком,
+    когда ALBUM_WAIT секунд не приходило новых частей"""
+
+    MAX_PARTS = 10  # больше в альбоме не бывает — отправляем сразу
+
+    def __init__(self, wait, handler):
+        self.wait = wait
+        self.handler = handler
+        self._parts = {}  # (chat_id, media_group_id) -> [Message]
+        self._timers = {}  # (chat_id, media_group_id) -> TimerHandle
+        self._tasks = set()
+
+    def add(self, msg):
+        key = (msg.chat.id, msg.media_group_id)
+        parts = self._parts.setdefault(key, [])
+        parts.append(msg)
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        if len(parts) >= self.MAX_PARTS:
+            self._flush(key)
+        else:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.wait, self._flush, key)
+
+    def _flush(self, key):
+        self._timers.pop(key, None)
+        parts = self._parts.pop(key, None)
+        if not parts:
+            return
+        parts.sort(key=lambda m: m.message_id)
+        task = asyncio.create_task(self.handler(parts))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+def _album_item(msg):
+    """(InputMedia для send_media_group, сам файл) для части альбома"""
+    if msg.photo:
+        return InputMediaPhoto, msg.photo[-1]
+    if msg.video:
+        return InputMediaVideo, msg.video
+    if msg.audio:
+        return InputMediaAudio, msg.audio
+    if msg.document:
+        return InputMediaDocument, msg.document
+    return None, None
+
+async def tg_album_to_dc(parts):
+    """Альбом: один send_media_group на чат TG и одно сообщение webhook с файлами в DC"""
+    first = parts[0]
+    is_group, sender_name, tg_header = tg_sender(first)
+    content = next((m.caption.strip() for m in parts if m.caption and m.caption.strip()), "")[:2000]
+
+    reply_group = None
+    if first.reply_to_message:
+        reply_group = links.by_tg(first.chat.id, first.reply_to_message.message_id)
+
+    gid = links.new_group(LinkStore.ORIGIN_TG)
+    for m in parts:
+        links.add_tg(gid, m.chat.id, m.message_id)
+
+    items = [(m, *_album_item(m)) for m in parts]
+    items = [(m, kind, media) for m, kind, media in items if kind]
+
+    # Подпись — только у первого элемента, как у обычного альбома
+    caption = f"{tg_header}\n{content}" if content else tg_header
+    album = []
+    for m, kind, media in items:
+        if album:
+            album.append(kind(media=media.file_id))
+        else:
+            album.append(kind(media=media.file_id, caption=caption, parse_mode="HTML"))
+
+    async def album_to_tg():
+        # Через outbox: альбом из file_id можно переотправить после сбоя или перезапуска
+        result = await outbox.broadcast(
+            get_target_chats(routing.channel_for(first.chat.id)),
+            "send_input_media",
+            {"media": input_media_args(album)},
+            reply_group=reply_group,
+            gid=gid,
+            exclude=str(first.chat.id),
+            label="TG→TG album"
+        )
+        links.add_result(gid, result)
+
+    # Как и для одиночных сообщений: TG и Discord параллельно
+    tg_leg = asyncio.create_task(bridge_leg(album_to_tg(), "TG→TG album")) if album else None
+    blobs = []
+    reserved = 0
+    try:
+        channel = dc.get_channel(routing.channel_for(first.chat.id))
+        if not channel:
+            return
+
+        # Лимит сервера — на весь запрос, поэтому считаем суммарный размер
+        guild = channel.guild
+        upload_limit = dc_upload_limit(guild)
+        files = []
+        skipped = 0
+        total = 0
+        selected = []
+        for m, kind, media in items:
+            if media.file_size and (media.file_size > TG_DOWNLOAD_LIMIT or total + media.file_size > guild.filesize_limit):
+                skipped += 1
+                continue
+            total += media.file_size or 0
+            selected.append(media)
+
+        # Место в бюджете загрузок — сразу на весь альбом
+        reserved = await downloads.acquire(total)
+        for media in selected:
+            media_key = f"tg:{media.file_unique_id}"
+            blob = await media_cache.blob(
+                media_key,
+                lambda: MediaBlob.from_telegram(media.file_id, getattr(media, "file_name", None), media.file_size, prepaid=True)
+            )
+            blobs.append(blob)
+            files.append(blob.discord_file())
+
+        dc_content = content
+        if reply_group and reply_group.dc_id:
+            reply_link = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{reply_group.dc_id}"
+            dc_content = f"⤴️ [В ответ]({reply_link})\n{dc_content}"
+        if skipped:
+            dc_content = f"{dc_content}\nНе влезло в {size_mb(upload_limit)}: {skipped} файлов".strip()
+
+        payload = {
+            "username": sender_name[:32],
+            "wait": True
+        }
+        if dc_content or not files:
+            payload["content"] = dc_content or "…"
+        if files:
+            payload["files"] = files
+        avatar_url = await get_avatar_url(first, is_group)
+        if avatar_url:
+            payload["avatar_url"] = avatar_url
+
+        sent = await send_via_webhook(channel, **payload)
+        links.set_dc(gid, sent.id)
+        print(f"TG→DC album ok: {len(parts)} частей → {sent.id}")
+    except Exception as e:
+        print(f"❌ TG→DC album: {type(e).__name__}: {e}")
+    finally:
+        if tg_leg:
+            await tg_leg
+        for blob in blobs:
+            blob.close()
+        if reserved:
+            downloads.release(reserved)
+
+albums = AlbumCollector(ALBUM_WAIT, tg_album_to_dc)
 
 # ───────── TG → DC: редактирование ─────────
 @router.edited_message()
@@ -1131,13 +3140,13 @@ async def tg_edited_to_dc(msg: Message):
     if not state["enabled"] or not is_allowed(msg.chat.id):
         return
 
-    dc_msg_id_str = state["reply_map"].get(str(msg.message_id))
-    if not dc_msg_id_str:
+    group = links.by_tg(msg.chat.id, msg.message_id)
+    if not group or not group.dc_id:
         return
+    dc_msg_id = group.dc_id
 
     try:
-        guild = dc.get_guild(GUILD_ID)
-        channel = guild.get_channel(state["discord_channel_id"])
+        channel = dc.get_channel(routing.channel_for(msg.chat.id))
         if not channel:
             return
 
@@ -1159,88 +3168,227 @@ async def tg_edited_to_dc(msg: Message):
             new_content = (msg.text or msg.caption or "").strip()[:2000] or "…"
 
         await webhook.edit_message(
-            message_id=int(dc_msg_id_str),
+            message_id=dc_msg_id,
             content=new_content
         )
-        print(f"Edit TG→DC ok: {msg.message_id} → {dc_msg_id_str}")
-
-    except discord.NotFound:
-        print(f"Edit TG→DC: уже удалено в DC {dc_msg_id_str}")
-        state["reply_map"].pop(str(msg.message_id), None)
-        state["reply_map"].pop(dc_msg_id_str, None)
-        save_state()
+        print(f"Edit TG→DC ok: {msg.message_id} → {dc_msg_id}")
+
+    except discord.HTTPException as e:
+        if webhook_gone(e):
+            print(f"Edit TG→DC: webhook недоступен, сбрасываем кэш: {e}")
+            invalidate_webhook(channel.id)
+        elif isinstance(e, discord.NotFound):
+            print(f"Edit TG→DC: уже удалено в DC {dc_msg_id}")
+            links.drop(group.gid)
+        else:
+            print(f"❌ Edit TG→DC: {type(e).__name__}: {e}")
     except Exception as e:
         print(f"❌ Edit TG→DC: {type(e).__name__}: {e}")
 
 # ───────── DISCORD ─────────
+# В один альбом Telegram можно сложить только фото с видео, аудио с аудио, документы с документами
+_ALBUM_GROUP = {InputMediaPhoto: "visual", InputMediaVideo: "visual", InputMediaAudio: "audio", InputMediaDocument: "document"}
+
+def _attachment_kind(att):
+    """Как отправить вложение Discord в Telegram"""
+    content_type = att.content_type or ""
+    # GIF фото сделает статичным, а фото больше 10 MB Telegram не примет — такие шлём документом
+    if content_type.startswith("image/") and content_type != "image/gif" and att.size <= 10 * 1024 * 1024:
+        return InputMediaPhoto
+    if content_type.startswith("video/"):
+        return InputMediaVideo
+    if content_type.startswith("audio/"):
+        return InputMediaAudio
+    return InputMediaDocument
+
+def _attachment_url(att, kind):
+    """Ссылка CDN, если Telegram сможет скачать вложение сам (фото до 5 MB, остальное до 20 MB,
+    документом по ссылке принимаются только PDF, ZIP и GIF)"""
+    limit = 5 * 1024 * 1024 if kind is InputMediaPhoto else 20 * 1024 * 1024
+    if att.size > limit:
+        return None
+    if kind is InputMediaDocument and not att.filename.lower().endswith((".pdf", ".zip", ".gif")):
+        return None
+    return att.url
+
+def _attachment_blob(att, blobs):
+    """get_blob для broadcast_media_group (бюджет загрузок она бронирует сама):
+    скачанные файлы складываем в blobs, чтобы потом закрыть. Мимо кэша: id вложения
+    уникален для каждой загрузки, повторно тот же файл не придёт"""
+    async def get_blob():
+        blob = await MediaBlob.from_attachment(att, prepaid=True)
+        blobs.append(blob)
+        return blob
+    return get_blob
+
 intents = discord.Intents.all()
 intents.message_content = True
 intents.polls = True
 dc = discord.Client(intents=intents)
 
+class DcBackfill:
+    """Догонка: всё, что появилось в каналах DC, пока бот был оффлайн или шлюз отваливался,
+    дочитываем через историю канала после последнего увиденного сообщения"""
+
+    def __init__(self, batch, max_age):
+        self.batch = batch
+        self.max_age = max_age
+        self._running = {}  # id канала -> пришли ли живые сообщения, пока догоняем
+
+    def seen(self, message):
+        """Запомнить последнее увиденное сообщение канала"""
+        channel_id_str = str(message.channel.id)
+        if message.id > state["dc_last_seen"].get(channel_id_str, 0):
+            state["dc_last_seen"][channel_id_str] = message.id
+            save_state()
+
+    def busy(self, message):
+        """Канал сейчас догоняется — живое сообщение дойдёт через историю, по порядку"""
+        if message.channel.id not in self._running:
+            return False
+        self._running[message.channel.id] = True
+        return True
+
+    def claim(self):
+        """Сразу, до первого await, отметить все каналы как догоняемые и запомнить, откуда догонять:
+        иначе живое сообщение в канале, до которого очередь ещё не дошла, сдвинуло бы dc_last_seen"""
+        claimed = {}
+        for channel_id in routing.channels():
+            last_seen = state["dc_last_seen"].get(str(channel_id))
+            if last_seen and channel_id not in self._running:  # Канал ещё не видели — догонять не от чего
+                self._running[channel_id] = False
+                claimed[channel_id] = last_seen
+        return claimed
+
+    async def run(self, channel_id, last_seen):
+        """Догнать канал, отмеченный в claim"""
+        count = 0
+        try:
+            channel = dc.get_channel(channel_id)
+            if channel is None:
+                return
+            # Дольше max_age не догоняем: после долгого простоя это был бы уже не мост, а спам
+            oldest = discord.utils.time_snowflake(discord.utils.utcnow() - timedelta(seconds=self.max_age))
+            after = max(last_seen, oldest)
+            while True:
+                page = [m async for m in channel.history(after=discord.Object(id=after), oldest_first=True, limit=self.batch)]
+                live = self._running[channel_id]
+                self._running[channel_id] = False
+                if not page:
+                    if live:
+                        continue  # Пока ждали историю, пришло новое — перечитаем
+                    break
+                for message in page:
+                    after = message.id
+                    self.seen(message)
+                    if dc_should_bridge(message):
+                        # По одному: отправки проходят через RateLimitMiddleware, флуд-лимиты не сработают
+                        await bridge_dc_message(message)
+                        count += 1
+        except Exception as e:
+            print(f"⚠️ Догонка канала DC {channel_id}: {type(e).__name__}: {e}")
+        finally:
+            del self._running[channel_id]
+        if count:
+            print(f"⏩ Догнали канал DC {channel_id}: {count} сообщ.")
+
+    async def run_all(self, claimed):
+        """Каналы догоняем параллельно, внутри канала — по порядку"""
+        await asyncio.gather(*(self.run(channel_id, last_seen) for channel_id, last_seen in claimed.items()))
+
+dc_backfill = DcBackfill(DC_BACKFILL_BATCH, DC_BACKFILL_MAX_AGE)
+
+def dc_should_bridge(message):
+    """Пересылать ли сообщение DC в Telegram"""
+    if message.author.bot or message.webhook_id:
+        return False
+    if not state["enabled"] or state.get("dnd"):
+        return False
+    return routing.bridged(message.channel.id)
+
 @dc.event
 async def on_ready():
     print(f"🟢 Discord готов: {dc.user}")
+    asyncio.create_task(dc_backfill.run_all(dc_backfill.claim()))
+
+@dc.event
+async def on_resumed():
+    asyncio.create_task(dc_backfill.run_all(dc_backfill.claim()))
 
 @dc.event
 async def on_message(message: discord.Message):
-    if message.author.bot or message.webhook_id:
+    if not routing.bridged(message.channel.id):
         return
-    if not state["enabled"] or state.get("dnd"):
+    if dc_backfill.busy(message):
         return
-    if message.channel.id != state["discord_channel_id"]:
+    dc_backfill.seen(message)
+    if not dc_should_bridge(message):
         return
+    await bridge_dc_message(message)
 
+async def bridge_dc_message(message):
+    """Переслать сообщение DC во все чаты его моста"""
+    # Discord может повторить события при переподключении, догонка — перечитать уже пересланное
+    if links.processed("dc", message.channel.id, message.id):
+        return
     try:
-        tg_reply_id = None
+        # Группа связей сообщения, на которое отвечают — в каждом чате своя копия
+        reply_group = None
         if message.reference and message.reference.message_id:
-            # Ищем TG message_id для ответа
-            # Сначала проверяем прямую связь (для сообщений из TG)
-            tg_reply_id = state["reply_map"].get(str(message.reference.message_id))
-            # Если не нашли, проверяем tg_{dc_id} (для сообщений из DC)
-            if not tg_reply_id:
-                tg_reply_id = state["reply_map"].get(f"tg_{message.reference.message_id}")
+            reply_group = links.by_dc(message.reference.message_id)
+
+        gid = links.new_group(LinkStore.ORIGIN_DC)
+        links.set_dc(gid, message.id)
 
         header = f"<b>[DC | {message.author.display_name}]</b>"
         content = message.clean_content.strip()
-        saved_files = []
+        blobs = []
 
         if message.attachments:
+            # Вложения уходят альбомами (фото/видео, аудио, документы — отдельно, по 10 штук):
+            # один запрос на чат вместо запроса на каждый файл
+            groups = {}
             for att in message.attachments:
-                if att.size > 50_000_000:
-                    await send_to_all_users(
+                if att.size > TG_UPLOAD_LIMIT:
+                    result = await send_to_all_users(
                         f"{header}\nСлишком большой файл: {att.filename}",
-                        reply_to_message_id=int(tg_reply_id) if tg_reply_id else None,
+                        reply_group=reply_group,
+                        channel_id=message.channel.id,
+                        gid=gid,
                         parse_mode="HTML"
                     )
+                    links.add_result(gid, result)
                     continue
-
-                path = os.path.join(TMP_DIR, f"{att.id}_{att.filename}")
-                await att.save(path)
-                saved_files.append(path)
-
-                caption = f"{header}\n{content}" if att == message.attachments[0] and content else f"{header}\n{att.filename}"
-                # Отправляем всем пользователям
-                all_chats = get_target_chats()
-                first_tg_msg_id = None
-                for chat_id_str in all_chats:
-                    try:
-                        sent = await bot.send_document(
-                            int(chat_id_str),
-                            FSInputFile(path),
-                            caption=caption,
-                            reply_to_message_id=int(tg_reply_id) if tg_reply_id else None,
-                            parse_mode="HTML"
-                        )
-                        state["reply_map"][str(message.id)] = str(sent.message_id)
-                        state["reply_map"][str(sent.message_id)] = str(message.id)
-                        if first_tg_msg_id is None:
-                            first_tg_msg_id = sent.message_id
-                    except Exception as e:
-                        print(f"⚠️ Не удалось отправить файл в {chat_id_str}: {e}")
-                # Сохраняем первый TG message_id для ответов из DC
-                if first_tg_msg_id:
-                    state["reply_map"][f"tg_{message.id}"] = str(first_tg_msg_id)
+                kind = _attachment_kind(att)
+                groups.setdefault(_ALBUM_GROUP[kind], []).append((att, kind))
+
+            chunks = [
+                items[i:i + AlbumCollector.MAX_PARTS]
+                for items in groups.values()
+                for i in range(0, len(items), AlbumCollector.MAX_PARTS)
+            ]
+            for n, chunk in enumerate(chunks):
+                # Подпись — у первого элемента: текст сообщения только в первом альбоме
+                caption = f"{header}\n{content}" if n == 0 and content else header
+                items = []
+                for att, kind in chunk:
+                    extra = {} if items else {"caption": caption, "parse_mode": "HTML"}
+                    items.append((None, kind, _attachment_blob(att, blobs), _attachment_url(att, kind), extra))
+                result = await broadcast_media_group(
+                    get_target_chats(message.channel.id),
+                    items,
+                    lambda chat_id_str, media: send_input_media(
+                        int(chat_id_str),
+                        media,
+                        reply_to_message_id=tg_reply_to(reply_group, chat_id_str)
+                    ),
+                    size=sum(att.size for att, kind in chunk)
+                )
+                links.add_result(gid, result)
+                # Альбом ушёл — файлы больше не нужны, освобождаем бюджет до следующего
+                for blob in blobs:
+                    blob.close()
+                blobs.clear()
 
         elif message.stickers:
             for sticker in message.stickers:
@@ -1249,73 +3397,56 @@ async def on_message(message: discord.Message):
 
                 if sticker.format in (discord.StickerFormatType.png, discord.StickerFormatType.apng, discord.StickerFormatType.gif):
                     try:
-                        async with dc.http.get(sticker_url) as resp:
-                            if resp.status == 200:
-                                ext = "gif" if sticker.format == discord.StickerFormatType.gif else "png"
-                                path = os.path.join(TMP_DIR, f"dc_sticker_{sticker.id}.{ext}")
-                                with open(path, 'wb') as f:
-                                    f.write(await resp.read())
-
-                                caption = f"{header}\nСтикер"
-                                if content and sticker == message.stickers[0]:
-                                    caption = f"{header}\n{content}"
-
-                                # Отправляем всем как фото/анимацию
-                                all_chats = get_target_chats()
-                                first_tg_msg_id = None
-                                for chat_id_str in all_chats:
-                                    try:
-                                        if ext == "gif":
-                                            sent = await bot.send_animation(
-                                                int(chat_id_str),
-                                                animation=FSInputFile(path),
-                                                caption=caption,
-                                                reply_to_message_id=int(tg_reply_id) if tg_reply_id else None,
-                                                parse_mode="HTML"
-                                            )
-                                        else:
-                                            sent = await bot.send_photo(
-                                                int(chat_id_str),
-                                                photo=FSInputFile(path),
-                                                caption=caption,
-                                                reply_to_message_id=int(tg_reply_id) if tg_reply_id else None,
-                                                parse_mode="HTML"
-                                            )
-                                        state["reply_map"][str(message.id)] = str(sent.message_id)
-                                        state["reply_map"][str(sent.message_id)] = str(message.id)
-                                        if first_tg_msg_id is None:
-                                            first_tg_msg_id = sent.message_id
-                                    except Exception as e:
-                                        print(f"⚠️ Не удалось отправить в {chat_id_str}: {e}")
-                                saved_files.append(path)
-                                # Сохраняем первый TG message_id для ответов из DC
-                                if first_tg_msg_id:
-                                    state["reply_map"][f"tg_{message.id}"] = str(first_tg_msg_id)
-                                continue
+                        ext = "gif" if sticker.format == discord.StickerFormatType.gif else "png"
+                        media_key = f"dc:sticker:{sticker.id}"
+
+                        async def read_sticker():
+                            async def download():
+                                return MediaBlob(f"sticker.{ext}", data=await sticker.read())
+                            return await downloads.run(None, download)
+
+                        async def sticker_blob():
+                            blob = await media_cache.blob(media_key, read_sticker)
+                            blobs.append(blob)
+                            return blob
+
+                        caption = f"{header}\nСтикер"
+                        if content and sticker == message.stickers[0]:
+                            caption = f"{header}\n{content}"
+
+                        # Отправляем всем как фото/анимацию
+                        if ext == "gif":
+                            send = lambda chat_id_str, media: bot.send_animation(
+                                int(chat_id_str),
+                                animation=media,
+                                caption=caption,
+                                reply_to_message_id=tg_reply_to(reply_group, chat_id_str),
+                                parse_mode="HTML"
+                            )
+                        else:
+                            send = lambda chat_id_str, media: bot.send_photo(
+                                int(chat_id_str),
+                                photo=media,
+                                caption=caption,
+                                reply_to_message_id=tg_reply_to(reply_group, chat_id_str),
+                                parse_mode="HTML"
+                            )
+                        result = await broadcast_media(media_key, get_target_chats(message.channel.id), send, sticker_blob, url=sticker_url)
+                        links.add_result(gid, result)
+                        continue
                     except Exception as e:
                         print(f"⚠️ Не удалось скачать стикер DC: {e}")
 
                 # Для Lottie или если не удалось скачать — отправляем ссылкой
                 sticker_type = "Lottie" if sticker.format == discord.StickerFormatType.lottie else "Стикер"
-                all_chats = get_target_chats()
-                first_tg_msg_id = None
-                for chat_id_str in all_chats:
-                    try:
-                        sent = await bot.send_message(
-                            int(chat_id_str),
-                            f"{header}\n{sticker_type}: {sticker_url}",
-                            reply_to_message_id=int(tg_reply_id) if tg_reply_id else None,
-                            parse_mode="HTML"
-                        )
-                        state["reply_map"][str(message.id)] = str(sent.message_id)
-                        state["reply_map"][str(sent.message_id)] = str(message.id)
-                        if first_tg_msg_id is None:
-                            first_tg_msg_id = sent.message_id
-                    except Exception as e:
-                        print(f"Error sending to {chat_id_str}: {e}")
-                # Сохраняем первый TG message_id для ответов из DC
-                if first_tg_msg_id:
-                    state["reply_map"][f"tg_{message.id}"] = str(first_tg_msg_id)
+                result = await send_to_all_users(
+                    f"{header}\n{sticker_type}: {sticker_url}",
+                    reply_group=reply_group,
+                    channel_id=message.channel.id,
+                    gid=gid,
+                    parse_mode="HTML"
+                )
+                links.add_result(gid, result)
 
         elif message.poll:
             poll = message.poll
@@ -1323,114 +3454,96 @@ async def on_message(message: discord.Message):
             poll_status = "✅ Завершено" if poll.is_finalized else "🔓 Активно"
             poll_text = f"📊 Опрос: {poll.question}\n\n{poll_options}\n\n{poll_status}"
 
-            sent_list = await send_to_all_users(
+            result = await send_to_all_users(
                 f"{header}\n{poll_text}",
-                reply_to_message_id=int(tg_reply_id) if tg_reply_id else None,
+                reply_group=reply_group,
+                channel_id=message.channel.id,
+                gid=gid,
                 parse_mode="HTML"
             )
-            if sent_list:
-                first_chat, first_msg_id = sent_list[0]
-                state["reply_map"][str(message.id)] = str(first_msg_id)
-                state["reply_map"][str(first_msg_id)] = str(message.id)
-                state["reply_map"][f"tg_{message.id}"] = str(first_msg_id)
-                state["reply_map"][f"poll_{first_msg_id}"] = "dc"
-            save_state()
-            print(f"DC→TG poll ok: {message.id} → {sent_list[0][1] if sent_list else 'N/A'}")
+            links.add_result(gid, result)
+            print(f"DC→TG poll ok: {message.id} → {result.ok_count} чатов")
 
         elif content:
-            sent_list = await send_to_all_users(
+            result = await send_to_all_users(
                 f"{header}\n{content}",
-                reply_to_message_id=int(tg_reply_id) if tg_reply_id else None,
+                reply_group=reply_group,
+                channel_id=message.channel.id,
+                gid=gid,
                 parse_mode="HTML"
             )
-            if sent_list:
-                first_chat, first_msg_id = sent_list[0]
-                state["reply_map"][str(message.id)] = str(first_msg_id)
-                state["reply_map"][str(first_msg_id)] = str(message.id)
-                state["reply_map"][f"tg_{message.id}"] = str(first_msg_id)
+            links.add_result(gid, result)
 
-        save_state()
-        print(f"DC→TG ok: {message.id} → {state['reply_map'].get(str(message.id), '?')}")
+        group = links.by_dc(message.id)
+        print(f"DC→TG ok: {message.id} → {len(group.copies) if group else 0} чатов")
 
     except Exception as e:
         print(f"❌ DC→TG: {type(e).__name__}: {e}")
     finally:
-        for p in saved_files:
-            if os.path.exists(p):
-                try:
-                    os.remove(p)
-                except:
-                    pass
+        for blob in blobs:
+            blob.close()
 
 @dc.event
 async def on_message_edit(before, after):
-    if after.author.bot or after.webhook:
+    if after.author.bot or after.webhook_id:
         return
     if not state["enabled"] or state.get("dnd"):
         return
-    if after.channel.id != state["discord_channel_id"]:
+    if not routing.bridged(after.channel.id):
         return
 
-    tg_msg_id_str = state["reply_map"].get(str(after.id))
-    if not tg_msg_id_str:
+    group = links.by_dc(after.id)
+    if not group or not group.copies:
         return
 
     try:
         header = f"<b>[DC | {after.author.display_name}]</b> ✏️"
         new_content = after.clean_content.strip() or "…"
 
-        # Редактиру��м у всех пользователей
-        all_chats = get_target_chats()
-        for chat_id_str in all_chats:
-            try:
-                await bot.edit_message_text(
-                    chat_id=int(chat_id_str),
-                    message_id=int(tg_msg_id_str),
-                    text=f"{header}\n{new_content}",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
-        print(f"Edit DC→TG ok: {after.id} → {tg_msg_id_str}")
+        # Редактируем копию в каждом чате, куда сообщение было разослано
+        await fanout.broadcast(
+            group.tg_chats(),
+            lambda chat_id_str: bot.edit_message_text(
+                chat_id=int(chat_id_str),
+                message_id=group.tg_message_id(chat_id_str),
+                text=f"{header}\n{new_content}",
+                parse_mode="HTML"
+            ),
+            label="правка в TG"
+        )
+        print(f"Edit DC→TG ok: {after.id} → {len(group.copies)} чатов")
 
     except Exception as e:
         print(f"❌ Edit DC→TG: {type(e).__name__}: {e}")
 
 @dc.event
 async def on_message_delete(message):
-    if message.author.bot or message.webhook:
+    if message.author.bot or message.webhook_id:
         return
     if not state["enabled"] or state.get("dnd"):
         return
-    if message.channel.id != state["discord_channel_id"]:
+    if not routing.bridged(message.channel.id):
         return
 
-    tg_msg_id_str = state["reply_map"].get(str(message.id))
-    if not tg_msg_id_str:
+    group = links.by_dc(message.id)
+    if not group or not group.copies:
         return
 
     try:
-        # Удаляем у всех пользователей
-        all_chats = get_target_chats()
-        for chat_id_str in all_chats:
-            try:
-                await bot.delete_message(
-                    chat_id=int(chat_id_str),
-                    message_id=int(tg_msg_id_str)
-                )
-            except:
-                pass
-        print(f"Delete DC→TG ok: {message.id} → {tg_msg_id_str} (удалено)")
-
-        state["reply_map"].pop(str(message.id), None)
-        state["reply_map"].pop(tg_msg_id_str, None)
-        save_state()
-
+        # Удаляем все копии в каждом чате
+        await fanout.broadcast(
+            group.tg_chats(),
+            lambda chat_id_str: bot.delete_messages(
+                chat_id=int(chat_id_str),
+                message_ids=group.copies[int(chat_id_str)]
+            ),
+            label="удаление в TG"
+        )
+        print(f"Delete DC→TG ok: {message.id} → {len(group.copies)} чатов (удалено)")
     except Exception as e:
         print(f"❌ Delete DC→TG: {type(e).__name__}: {e}")
-        state["reply_map"].pop(str(message.id), None)
-        state["reply_map"].pop(tg_msg_id_str, None)
-        save_state()
+    finally:
+        links.drop(group.gid)
 
 # ───────── DC: Обновление опросов ─────────
 @dc.event
@@ -1440,19 +3553,18 @@ async def on_raw_poll_vote_add(payload):
         return
 
     channel_id = int(payload.channel_id)
-    if channel_id != state["discord_channel_id"]:
+    if not routing.bridged(channel_id):
         return
 
-    tg_msg_id = state["reply_map"].get(str(payload.message_id))
-    if not tg_msg_id:
+    group = links.by_dc(payload.message_id)
+    if not group or not group.copies:
         return
 
     # Проверяем, не является ли это TG опросом (их нельзя редактировать)
-    poll_key = f"poll_{tg_msg_id}"
-    if state["reply_map"].get(poll_key) == "tg":
-        print(f"⛔ Skip TG poll update: {tg_msg_id}")
+    if group.origin == LinkStore.ORIGIN_TG:
+        print(f"⛔ Skip TG poll update: {payload.message_id}")
         return
-    
+
     try:
         channel = await dc.fetch_channel(channel_id)
         message = await channel.fetch_message(payload.message_id)
@@ -1468,17 +3580,16 @@ async def on_raw_poll_vote_add(payload):
         author_name = message.author.display_name if hasattr(message, 'author') and message.author else "Unknown"
 
         # Редактируем у всех пользователей
-        all_chats = get_target_chats()
-        for chat_id_str in all_chats:
-            try:
-                await bot.edit_message_text(
-                    chat_id=int(chat_id_str),
-                    message_id=int(tg_msg_id),
-                    text=f"<b>[DC | {author_name}]</b>\n{poll_text}",
-                    parse_mode="HTML"
-                )
-            except:
-                pass
+        await fanout.broadcast(
+            group.tg_chats(),
+            lambda chat_id_str: bot.edit_message_text(
+                chat_id=int(chat_id_str),
+                message_id=group.tg_message_id(chat_id_str),
+                text=f"<b>[DC | {author_name}]</b>\n{poll_text}",
+                parse_mode="HTML"
+            ),
+            label="опрос в TG"
+        )
         print(f"✅ Poll vote DC→TG update: {payload.message_id}")
     except Exception as e:
         print(f"❌ Poll vote DC→TG: {e}")
@@ -1493,11 +3604,20 @@ async def main():
     shutil.rmtree(TMP_DIR, ignore_errors=True)
     os.makedirs(TMP_DIR, exist_ok=True)
 
-    asyncio.create_task(dc.start(DC_TOKEN))
-    await dp.start_polling(
-        bot,
-        allowed_updates=["message", "edited_message", "callback_query"]
-    )
+    persist.start()
+    try:
+        asyncio.create_task(dc.start(DC_TOKEN))
+        asyncio.create_task(downloads.janitor(TMP_JANITOR_INTERVAL))
+        asyncio.create_task(chat_health.prober())
+        # Досылаем то, что не успели доставить до перезапуска
+        outbox.replay()
+        await dp.start_polling(
+            bot,
+            allowed_updates=["message", "edited_message", "callback_query", "my_chat_member"]
+        )
+    finally:
+        # Принудительно сбрасываем всё, что ещё не записано
+        persist.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())